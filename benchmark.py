@@ -0,0 +1,355 @@
+'''
+Created on 18 Oct 2026
+
+@author: pingshiyu
+'''
+'''
+Benchmarks of each stage of the pipeline, on synthetic data so they run offline and need none of the scraped data:
+    download -> shrink -> detect -> scrape loop -> square -> encode -> feature store -> regression
+
+Generators make stand-ins for each stage's input: link JSONs pointing at a local HTTP server, raw faces (.png with
+a .csv sidecar), square shard databases and feature stores. Encoding uses a tiny random network shaped like VGG's
+end (vgg_backends.write_tiny_network) rather than the full VGG weights.
+
+Each stage is timed over a few repeats and the results written as JSON (to ``./data/benchmarks/`` by default), along
+with the versions and machine they were run on, so runs can be compared over time. A stage which cannot run (e.g. its
+library is not installed) is recorded with its error instead of stopping the rest.
+'''
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from io import BytesIO
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+from PIL import Image
+
+# location of benchmark results
+results_root = './data/benchmarks/'
+
+def make_images(count, width=1600, height=1200, seed=0):
+    '''
+    Returns ``count`` smooth random RGB images (uint8 numpy arrays), a rough stand-in for photos: mostly low
+    frequencies, with some noise
+    '''
+    random = np.random.RandomState(seed)
+    images = []
+    for _ in range(count):
+        coarse = random.randint(0, 256, (height // 40 + 1, width // 40 + 1, 3)).astype(np.uint8)
+        image = np.asarray(Image.fromarray(coarse).resize((width, height), Image.BICUBIC), dtype=np.int16)
+        image = image + random.randint(-8, 9, image.shape)
+        images.append(np.clip(image, 0, 255).astype(np.uint8))
+    return images
+
+def encode_image(image, format='JPEG'):
+    '''
+    Returns the numpy ``image`` as the bytes of an image file
+    '''
+    out = BytesIO()
+    Image.fromarray(image).save(out, format)
+    return out.getvalue()
+
+def make_link_jsons(folder, urls, num_files=2, links_per_post=3, seed=0):
+    '''
+    Writes ``num_files`` link files like those in ./data/image_links/ to ``folder``: JSON lists of posts
+    [links, gender, rating, age], taking the links from ``urls`` in turn
+    '''
+    random = np.random.RandomState(seed)
+    os.makedirs(folder, exist_ok=True)
+    posts = [[urls[i:i+links_per_post], random.choice(['M', 'F']), round(float(random.uniform(1, 10)), 1),
+              str(random.randint(16, 40))]
+             for i in range(0, len(urls), links_per_post)]
+    for n in range(num_files):
+        with open(os.path.join(folder, 'images-{}'.format(n)), 'w') as f:
+            json.dump(posts[n::num_files], f)
+
+def make_raw_faces(folder, count, size=150, seed=0):
+    '''
+    Writes ``count`` raw faces as saved by save_faces.py to ``folder``: <n>.png, with <n>.csv holding
+    [n, gender, rating, age]
+    '''
+    random = np.random.RandomState(seed)
+    os.makedirs(folder, exist_ok=True)
+    for n, image in enumerate(make_images(count, size, int(size * 1.2), seed)):
+        Image.fromarray(image).save(os.path.join(folder, '{}.png'.format(n)))
+        with open(os.path.join(folder, '{}.csv'.format(n)), 'w') as f:
+            json.dump([n, random.choice(['M', 'F']), round(float(random.uniform(1, 10)), 1),
+                       str(random.randint(16, 40))], f)
+
+def make_square_database(path, count, dim=224, seed=0):
+    '''
+    Writes a square shard database of ``count`` random faces to ``path``
+    '''
+    from shard_database import ShardWriter
+    random = np.random.RandomState(seed)
+    with ShardWriter(path, image_shape=(dim, dim, 3), overwrite=True) as writer:
+        for start in range(0, count, 100):
+            n = min(100, count - start)
+            writer.append_batch(random.randint(0, 256, (n, dim, dim, 3)).astype(np.uint8),
+                                np.c_[random.uniform(1, 10, n), random.randint(16, 40, n)])
+
+def make_feature_store(path, count, width=4096, seed=0):
+    '''
+    Writes a feature store of ``count`` random rows to ``path``, the ratings being a noisy linear function of the
+    features so there is something to fit
+    '''
+    from feature_store import FeatureStore
+    random = np.random.RandomState(seed)
+    weights = random.randn(width) / width**0.5
+    store = FeatureStore(path, width=width, overwrite=True)
+    for start in range(0, count, 4096):
+        features = np.maximum(random.randn(min(4096, count - start), width), 0).astype(np.float32)
+        ratings = np.dot(features, weights) + 5 + random.randn(len(features))
+        store.append(features, np.c_[ratings, random.randint(16, 40, len(features))])
+    return store
+
+class StubServer():
+    def __init__(self, files, latency=0.0):
+        '''
+        Serves the bytes of ``files`` (a dict of path to bytes) over HTTP on localhost, after ``latency`` seconds per
+        request, on a background thread. Other paths are 404s.
+        '''
+        class StubHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            def do_GET(self):
+                time.sleep(latency)
+                body = files.get(self.path)
+                self.send_response(200 if body is not None else 404)
+                self.send_header('Content-Type', 'image/jpeg')
+                self.send_header('Content-Length', str(len(body or b'')))
+                self.end_headers()
+                self.wfile.write(body or b'')
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def measure(run, items, repeat=3):
+    '''
+    Times ``run()``, which processes ``items`` items, ``repeat`` times.
+    Returns a dict of the best and median seconds, and the items per second and milliseconds per item of the best
+    '''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    best = min(times)
+    return {'items': items,
+            'repeat': repeat,
+            'best_seconds': best,
+            'median_seconds': float(np.median(times)),
+            'items_per_second': items / best if best > 0 else float('inf'),
+            'ms_per_item': 1000 * best / max(items, 1)}
+
+def bench_download(workdir, count=50, latency=0.05, repeat=3):
+    '''
+    Downloading and decoding JPEGs through ImageDownloader from a local server answering after ``latency`` seconds,
+    serially and concurrently, decoded in full and at reduced scale
+    '''
+    from downloader import ImageDownloader
+    files = {'/{}.jpg'.format(n): encode_image(image) for n, image in enumerate(make_images(count))}
+    with StubServer(files, latency) as server, ImageDownloader(max_workers=16, max_per_host=16) as downloader:
+        urls = [server.url + path for path in files]
+        serial = lambda fetch: [fetch(url) for url in urls]
+        # on the download threads
+        concurrent = lambda fetch: [future.result() for future in [downloader.submit(url, fetch) for url in urls]]
+        draft = lambda url: downloader.fetch(url, 1200)
+        return {'serial': measure(lambda: serial(downloader.fetch), count, repeat),
+                'concurrent': measure(lambda: concurrent(downloader.fetch), count, repeat),
+                'serial_draft': measure(lambda: serial(draft), count, repeat),
+                'concurrent_draft': measure(lambda: concurrent(draft), count, repeat)}
+
+def bench_shrink(workdir, count=20, repeat=3):
+    '''
+    Shrinking decoded photos for face detection (save_faces._shrink_image)
+    '''
+    from save_faces import _shrink_image, MAX_DIM, SOURCE_DIM
+    images = [Image.fromarray(image) for image in make_images(count, 3000, 2250)]
+    return {'max_dim': measure(lambda: [_shrink_image(image, MAX_DIM) for image in images], count, repeat),
+            'source_dim': measure(lambda: [_shrink_image(image, SOURCE_DIM) for image in images], count, repeat)}
+
+def bench_detect(workdir, count=10, repeat=3):
+    '''
+    Face detection on prepared images (save_faces._detect_face), the CPU-heavy stage of the scraper
+    '''
+    from save_faces import _detect_face, SOURCE_DIM
+    images = make_images(count, SOURCE_DIM, SOURCE_DIM * 3 // 4)
+    return measure(lambda: [_detect_face(image) for image in images], count, repeat)
+
+def bench_scrape(workdir, count=60, latency=0.05, processes=2, detect=None, repeat=3):
+    '''
+    The scraper's loop over link files (save_faces.find_post_faces): posts are read from link JSONs pointing at a
+    local server, and their links downloaded, shrunk and searched for faces through a FacePipeline of
+    ``processes`` detection processes. ``detect`` defaults to the scraper's (save_faces._detect_face).
+    '''
+    from downloader import ImageDownloader
+    from face_pipeline import FacePipeline
+    from save_faces import find_post_faces, _prepare_image, _detect_face, SOURCE_DIM
+    files = {'/{}.jpg'.format(n): encode_image(image) for n, image in enumerate(make_images(count))}
+    links_folder = os.path.join(workdir, 'image_links')
+    with StubServer(files, latency) as server, ImageDownloader(max_workers=16, max_per_host=16) as downloader, \
+            FacePipeline(downloader, _prepare_image, detect or _detect_face, processes=processes,
+                         max_dim=SOURCE_DIM) as pipeline:
+        make_link_jsons(links_folder, [server.url + path for path in files])
+        def scrape():
+            for file in sorted(os.listdir(links_folder)):
+                with open(os.path.join(links_folder, file)) as f:
+                    for _ in find_post_faces(json.load(f), pipeline):
+                        pass
+        return measure(scrape, count, repeat)
+
+def bench_square(workdir, count=200, repeat=3):
+    '''
+    Squaring raw faces (image_processing.resize_to_square), and building a square database from a raw face dump
+    (to_square_database.build_square_database)
+    '''
+    from image_processing import resize_to_square
+    from to_square_database import build_square_database
+    raw_folder = os.path.join(workdir, 'raw')
+    make_raw_faces(raw_folder, count)
+    faces = [np.asarray(Image.open(os.path.join(raw_folder, '{}.png'.format(n))).convert('RGB'))
+             for n in range(count)]
+    build = lambda: build_square_database(os.path.join(raw_folder, '*.png'), os.path.join(workdir, 'square_m'),
+                                          os.path.join(workdir, 'square_f'), workers=1, overwrite=True)
+    return {'resize_to_square': measure(lambda: [resize_to_square(face) for face in faces], count, repeat),
+            'build_square_database': measure(build, count, repeat)}
+
+def bench_encode(workdir, count=64, batch_size=16, size=64, backend='opencv', repeat=3):
+    '''
+    Preprocessing and encoding batches (VGG_Encoder.encode_batch) with a tiny stand-in network on ``backend``
+    '''
+    from vgg_backends import write_tiny_network
+    from vgg_encoder import VGG_Encoder
+    model_path, weights_path = os.path.join(workdir, 'tiny.prototxt'), os.path.join(workdir, 'tiny.caffemodel')
+    write_tiny_network(model_path, weights_path, size=size)
+    vgg = VGG_Encoder(np.array([129, 105, 94]), model_path, weights_path, backend=backend)
+    images = np.random.RandomState(0).randint(0, 256, (count, size, size, 3)).astype(np.uint8)
+    batches = [images[i:i+batch_size] for i in range(0, count, batch_size)]
+    return {'preprocess': measure(lambda: [vgg.preprocess(batch) for batch in batches], count, repeat),
+            'encode_batch': measure(lambda: [vgg.encode_batch(batch) for batch in batches], count, repeat)}
+
+def bench_feature_store(workdir, count=8192, width=4096, repeat=3):
+    '''
+    Writing and reading back a feature store of ``count`` rows of ``width`` features
+    '''
+    from feature_store import FeatureStore
+    path = os.path.join(workdir, 'store')
+    random = np.random.RandomState(0)
+    features = random.rand(count, width).astype(np.float32)
+    labels = random.rand(count, 2).astype(np.float32)
+    def write():
+        store = FeatureStore(path, width=width, overwrite=True)
+        for start in range(0, count, 4096):
+            store.append(features[start:start+4096], labels[start:start+4096])
+    def read():
+        for _, chunk_features, chunk_labels in FeatureStore(path).iter_chunks(4096):
+            np.asarray(chunk_features).sum(); np.asarray(chunk_labels).sum()
+    result = {'write': measure(write, count, repeat)}
+    result['read'] = measure(read, count, repeat)
+    result['mb'] = count * width * 4 / 1024**2
+    return result
+
+def bench_regression(workdir, count=8192, width=256, repeat=3):
+    '''
+    Fitting the streaming regression (regression_train.train_streaming) on a feature store of ``count`` rows
+    '''
+    from regression_train import train_streaming
+    path = os.path.join(workdir, 'regression_store')
+    make_feature_store(path, count, width)
+    metrics = {}
+    def fit():
+        metrics.update(train_streaming(path, epochs=5)['metrics']['rating'])
+    result = measure(fit, count, repeat)
+    result['test_metrics'] = metrics
+    return result
+
+STAGES = [('download', bench_download),
+          ('shrink', bench_shrink),
+          ('detect', bench_detect),
+          ('scrape', bench_scrape),
+          ('square', bench_square),
+          ('encode', bench_encode),
+          ('feature_store', bench_feature_store),
+          ('regression', bench_regression)]
+
+def run_benchmarks(stages=None, repeat=3, workdir=None):
+    '''
+    Runs the benchmarks of ``stages`` (names from ``STAGES``, all by default) in a scratch folder (``workdir``, or a
+    temporary folder removed afterwards).
+
+    Returns a dict of the results of each stage, and the environment they ran in
+    '''
+    scratch = workdir or tempfile.mkdtemp(prefix='benchmark-')
+    results = {'environment': environment(), 'stages': {}}
+    try:
+        for name, bench in STAGES:
+            if stages is not None and name not in stages:
+                continue
+            stage_dir = os.path.join(scratch, name)
+            os.makedirs(stage_dir, exist_ok=True)
+            start = time.perf_counter()
+            try:
+                results['stages'][name] = bench(stage_dir, repeat=repeat)
+            except Exception as e: # e.g. the stage's library is not installed
+                results['stages'][name] = {'error': '{}: {}'.format(type(e).__name__, e)}
+            print('{}: {:.1f}s'.format(name, time.perf_counter() - start))
+    finally:
+        if workdir is None:
+            shutil.rmtree(scratch, ignore_errors=True)
+    return results
+
+def environment():
+    '''
+    Returns a dict describing where the benchmarks ran: time, commit, python and library versions, and the machine
+    '''
+    import PIL, sklearn
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    return {'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'commit': commit,
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pillow': PIL.__version__,
+            'sklearn': sklearn.__version__,
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'cpus': os.cpu_count()}
+
+def save_results(results, path=None):
+    '''
+    Writes ``results`` as JSON to ``path``, by default a file named by the time of the run in ``results_root``.
+    Returns the path written.
+    '''
+    path = path or os.path.join(results_root, 'benchmark-{}.json'.format(time.strftime('%Y%m%d-%H%M%S')))
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=1)
+    return path
+
+if __name__ == '__main__':
+    results = run_benchmarks()
+    for name, result in results['stages'].items():
+        print(name, json.dumps(result))
+    print('saved to', save_results(results))
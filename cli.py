@@ -0,0 +1,205 @@
+'''
+Created on 18 Oct 2026
+
+@author: pingshiyu
+'''
+'''
+Single entry point for the stages of the pipeline:
+- scrape: find the faces in the scraped links, squaring them into the shard databases (save_faces.py)
+- square: square raw faces saved earlier into the shard databases (to_square_database.py)
+- encode: encode the squared faces with VGG into the feature stores (encode_faces.py)
+- train: train the rating and age models on a feature store (regression_train.py)
+- predict: rate the faces in image files, or serve the predictor over HTTP (predict_service.py)
+
+e.g.
+    python cli.py encode --gender female --batch-size 50 --workers 4 --backend opencv
+    python cli.py predict --model ./data/models/female.pkl photo.jpg
+
+Only the standard library is imported here. Each stage imports its modules (and so numpy, scikit-learn, dlib,
+caffe...) when it is run, so starting the CLI or asking any subcommand for ``--help`` is quick.
+'''
+import argparse
+import json
+import logging
+import os
+import threading
+
+GENDERS = ('female', 'male')
+
+def scrape(args):
+    from save_faces import scrape
+    scrape(links_root=args.links_root,
+           config=args.config,
+           square_root=None if args.no_squares else args.square_root,
+           raw_dir=args.raw_dir,
+           cache_path=args.cache,
+           download_threads=args.download_threads,
+           max_per_host=args.max_per_host,
+           processes=args.processes,
+           max_pending=args.max_pending,
+           metrics_path=args.metrics,
+           profile_stages=args.profile)
+
+def square(args):
+    from metrics import METRICS, MetricsExporter
+    from to_square_database import build_square_database
+    with MetricsExporter(METRICS, args.metrics, interval=30):
+        means = build_square_database(args.raw_glob,
+                                      male_path=os.path.join(args.square_root, 'male/'),
+                                      female_path=os.path.join(args.square_root, 'female/'),
+                                      workers=args.workers,
+                                      dim=args.dim,
+                                      shard_size=args.shard_size,
+                                      overwrite=args.overwrite)
+    for gender, mean in zip(('male', 'female'), means):
+        print('{} average: {}'.format(gender, mean))
+
+def encode(args):
+    import numpy as np
+    from metrics import METRICS, MetricsExporter
+    from encode_faces import encode_faces_to_store, mean_male, mean_female
+    with MetricsExporter(METRICS, args.metrics, interval=30):
+        for gender in args.gender:
+            path = os.path.join(args.square_root, gender + '/')
+            # the mean is fixed rather than the databases' current one, which changes as faces are scraped, as
+            # it is part of the encodings cache's fingerprint
+            mean = np.array(args.mean) if args.mean else (mean_female if gender == 'female' else mean_male)
+            encode_faces_to_store(path,
+                                  mean,
+                                  os.path.join(args.data_root, gender + '/'),
+                                  dtype=args.dtype,
+                                  cache_root=args.cache or os.path.join(args.data_root, 'cache/'),
+                                  batch_size=args.batch_size,
+                                  memory_budget=args.memory_budget * 1024**2,
+                                  workers=args.workers,
+                                  threads=args.threads,
+                                  backend=args.backend)
+
+def train(args):
+    from regression_train import train_streaming, save_model, plot_distributions
+    from similarity_index import load_groups
+    for gender in args.gender:
+        store_path = os.path.join(args.data_root, gender + '/')
+        if args.plot:
+            plot_distributions(store_path)
+        groups = None if args.no_groups else load_groups(store_path)
+        model = train_streaming(store_path, chunk_size=args.chunk_size, epochs=args.epochs,
+                                test_size=args.test_size, seed=args.seed, groups=groups)
+        print('{} test metrics: {}'.format(gender, model['metrics']))
+        save_model(model, os.path.join(args.model_root, gender + '.pkl'))
+
+def predict(args):
+    from predict_service import RatingPredictor, serve
+    predictor = RatingPredictor(args.model, args.mean,
+                                reducer_path=args.reducer,
+                                backend=args.backend,
+                                threads=args.threads,
+                                max_batch=args.max_batch,
+                                max_wait=args.max_wait)
+    try:
+        for file in args.images:
+            with open(file, 'rb') as f:
+                try:
+                    prediction = predictor.predict(f.read())
+                except ValueError as e:
+                    prediction = {'error': str(e)}
+            print(json.dumps({'file': file, 'prediction': prediction}))
+        if args.serve:
+            server = serve(predictor, args.host, args.port)
+            print('serving on http://{}:{}/predict'.format(*server.server_address))
+            try:
+                threading.Event().wait()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                server.shutdown()
+    finally:
+        predictor.close()
+
+def make_parser():
+    parser = argparse.ArgumentParser(description='Scrapes, squares, encodes, trains on and rates faces.')
+    parser.add_argument('--log-file', default=None, help='file to log to, by default the terminal')
+    parser.add_argument('--log-level', default='INFO', choices=('DEBUG', 'INFO', 'WARNING', 'ERROR'))
+    commands = parser.add_subparsers(dest='command', metavar='command')
+    commands.required = True
+
+    command = commands.add_parser('scrape', help='find the faces in the scraped links')
+    command.add_argument('--links-root', default='./data/image_links', help='folder of the link files')
+    command.add_argument('--config', default='./config/progress.config', help='progress through the link files')
+    command.add_argument('--square-root', default='./images/database_square/',
+                         help='folder of the male and female shard databases the faces are squared into')
+    command.add_argument('--no-squares', action='store_true', help='do not square the faces')
+    command.add_argument('--raw-dir', default=None, help='also save the raw faces (.png and .csv) to this folder')
+    command.add_argument('--cache', default='./data/face_cache_multires.sqlite', help='faces found before')
+    command.add_argument('--download-threads', type=int, default=16)
+    command.add_argument('--max-per-host', type=int, default=8, help='most downloads at once from one host')
+    command.add_argument('--processes', type=int, default=None, help='detection processes, by default all cores')
+    command.add_argument('--max-pending', type=int, default=128, help='most links in the pipeline at once')
+    command.add_argument('--metrics', default='./logs/save_faces.prom', help='file the metrics are written to')
+    command.add_argument('--profile', nargs='*', default=(), metavar='STAGE', help='stages to profile, e.g. decode')
+    command.set_defaults(run=scrape)
+
+    command = commands.add_parser('square', help='square raw faces into the shard databases')
+    command.add_argument('--raw-glob', default='./images/raw/*.png', help='raw faces, each with a .csv sidecar')
+    command.add_argument('--square-root', default='./images/database_square/')
+    command.add_argument('--workers', type=int, default=None, help='processes, by default all cores')
+    command.add_argument('--dim', type=int, default=224, help='size of the squared faces')
+    command.add_argument('--shard-size', type=int, default=1000, help='faces per shard')
+    command.add_argument('--overwrite', action='store_true',
+                         help='replace databases already in the square root, e.g. those the scraper added to')
+    command.add_argument('--metrics', default='./logs/to_square_database.prom')
+    command.set_defaults(run=square)
+
+    command = commands.add_parser('encode', help='encode the squared faces with VGG')
+    command.add_argument('--gender', nargs='+', choices=GENDERS, default=GENDERS)
+    command.add_argument('--square-root', default='./images/database_square/')
+    command.add_argument('--data-root', default='./data/vgg_encoded/', help='folder of the feature stores')
+    command.add_argument('--cache', default=None, help='encodings cache, by default in the data root')
+    command.add_argument('--mean', type=float, nargs=3, default=None,
+                         help='mean pixel values to encode with, by default those of encode_faces.py for the gender')
+    command.add_argument('--dtype', default='float32', choices=('float32', 'float16'))
+    command.add_argument('--batch-size', type=int, default=25, help='faces through the network at once')
+    command.add_argument('--memory-budget', type=int, default=256, help='MB of batches loaded ahead')
+    command.add_argument('--workers', type=int, default=1, help='processes, each with its own network')
+    command.add_argument('--threads', type=int, default=None, help='threads of each network')
+    command.add_argument('--backend', default='caffe', choices=('caffe', 'opencv'))
+    command.add_argument('--metrics', default='./logs/encode_faces.prom')
+    command.set_defaults(run=encode)
+
+    command = commands.add_parser('train', help='train the rating and age models')
+    command.add_argument('--gender', nargs='+', choices=GENDERS, default=('female',))
+    command.add_argument('--data-root', default='./data/vgg_encoded/', help='folder of the feature stores')
+    command.add_argument('--model-root', default='./data/models/', help='folder the models are saved to')
+    command.add_argument('--chunk-size', type=int, default=4096, help='rows read at a time')
+    command.add_argument('--epochs', type=int, default=5)
+    command.add_argument('--test-size', type=float, default=0.1)
+    command.add_argument('--seed', type=int, default=0)
+    command.add_argument('--no-groups', action='store_true', help='split by face rather than by duplicate group')
+    command.add_argument('--plot', action='store_true', help='plot the rating and age distributions first')
+    command.set_defaults(run=train)
+
+    command = commands.add_parser('predict', help='rate the faces in image files, or serve over HTTP')
+    command.add_argument('images', nargs='*', help='image files')
+    command.add_argument('--model', default='./data/models/female.pkl', help='model saved by train')
+    command.add_argument('--mean', type=float, nargs=3, default=None,
+                         help='mean pixel values the faces were encoded with, by default those saved with the model')
+    command.add_argument('--reducer', default=None, help='reduced store, if the model was trained on one')
+    command.add_argument('--backend', default='caffe', choices=('caffe', 'opencv'))
+    command.add_argument('--threads', type=int, default=None)
+    command.add_argument('--max-batch', type=int, default=16, help='most faces through the network at once')
+    command.add_argument('--max-wait', type=float, default=0.01, help='most seconds a face waits for a batch')
+    command.add_argument('--serve', action='store_true', help='serve over HTTP until interrupted')
+    command.add_argument('--host', default='127.0.0.1')
+    command.add_argument('--port', type=int, default=8008)
+    command.set_defaults(run=predict)
+    return parser
+
+def main(argv=None):
+    args = make_parser().parse_args(argv)
+    logging.basicConfig(filename=args.log_file,
+                        level=getattr(logging, args.log_level),
+                        format='%(asctime)s %(message)s')
+    args.run(args)
+
+if __name__ == '__main__':
+    main()
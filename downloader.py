@@ -0,0 +1,363 @@
+'''
+Created on 18 Oct 2026
+
+@author: pingshiyu
+'''
+'''
+Concurrent image downloader used by the scraper. Links are fetched on a bounded thread pool sharing a single
+``requests.Session``, so keep-alive connections to imgur are pooled and reused rather than opened per link.
+
+Each request has its own timeout (connect / read, plus an overall deadline for the whole body) instead of a
+process-wide signal alarm, and the number of requests in flight to any one host is capped.
+
+Images can be decoded as their body arrives (``fetch_image``), rather than after the whole body is buffered. JPEGs
+are then decoded at a reduced scale (draft mode, which has the decoder drop DCT coefficients) when only a smaller
+version of the image is needed, which takes a fraction of the CPU and memory of a full decode.
+
+The downloader only needs URLs, so it can be pointed at a local HTTP stand-in server - see ``__main__`` below.
+'''
+import hashlib
+import math
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from PIL import Image
+
+class ImageDownloader():
+    def __init__(self,
+                 max_workers=16,
+                 max_per_host=8,
+                 timeout=(3.05, 10),
+                 deadline=30,
+                 session=None):
+        '''
+        max_workers: number of download threads
+        max_per_host: maximum number of requests in flight to the same host
+        timeout: (connect, read) timeout in seconds, passed to ``requests`` for every request
+        deadline: maximum number of seconds allowed to receive a whole response body
+        session: optional ``requests.Session`` to use, a new one is created if not given
+        '''
+        self.timeout = timeout
+        self.deadline = deadline
+        self.max_per_host = max_per_host
+
+        # one connection pool per host, large enough for every thread to hold a connection
+        self.session = session if session is not None else requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._executor = ThreadPoolExecutor(max_workers)
+        self._host_slots = {}
+        self._host_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        '''
+        Stops the download threads and closes pooled connections
+        '''
+        self._executor.shutdown(wait=True)
+        self.session.close()
+
+    def fetch(self, url, max_dim=None):
+        '''
+        Downloads and decodes the image at ``url`` in the calling thread. The image is fully loaded, so no further
+        IO happens when it is used. See ``decode`` for ``max_dim``.
+
+        Returns a PIL image, or None if the link is dead or the content is not an image
+        '''
+        try:
+            _, image = self.fetch_image(url, max_dim)
+        except requests.RequestException as e: # timeout or connection failure
+            print('No image found on', url, '({})'.format(type(e).__name__))
+            return None
+        if image is None:
+            print('No image found on', url)
+        return image
+
+    def fetch_content(self, url):
+        '''
+        Downloads the body of ``url`` in the calling thread.
+
+        Returns the body as bytes, or None if the server says the link is dead (4xx response). Timeouts, connection
+        failures and server errors raise a ``requests.RequestException``, as they may succeed on another try.
+        '''
+        try:
+            with self._host_slot(url):
+                return self._get_content(url)
+        except requests.HTTPError as e:
+            if 400 <= e.response.status_code < 500:
+                return None
+            raise
+
+    def fetch_image(self, url, max_dim=None):
+        '''
+        Downloads the image at ``url`` in the calling thread, decoding it as the body arrives. See ``decode`` for
+        ``max_dim``.
+
+        Returns (digest, image): the SHA-1 hex digest of the whole body, and the fully loaded PIL image or None if the
+        body is not an image. Both are None if the server says the link is dead (4xx response). Timeouts, connection
+        failures and server errors raise a ``requests.RequestException``, as for ``fetch_content``.
+        '''
+        try:
+            with self._host_slot(url):
+                return self._get_image(url, max_dim)
+        except requests.HTTPError as e:
+            if 400 <= e.response.status_code < 500:
+                return None, None
+            raise
+
+    @staticmethod
+    def decode(content, max_dim=None):
+        '''
+        Decodes the downloaded ``content`` (bytes, or a file object). If ``max_dim`` is given, JPEGs are decoded at
+        the smallest of 1/2, 1/4 or 1/8 scale which still leaves their largest dimension at least ``max_dim``; other
+        formats are decoded in full.
+
+        Returns a fully loaded PIL image, or None if ``content`` is None or is not an image.
+        '''
+        if content is None:
+            return None
+        try:
+            image = Image.open(BytesIO(content) if isinstance(content, bytes) else content)
+            if max_dim is not None:
+                # does nothing for formats other than JPEG
+                image.draft(image.mode, _draft_size(image.size, max_dim))
+            image.load()
+            return image
+        except Exception: # not an image, or a corrupted one
+            return None
+
+    def submit(self, url, fetch=None):
+        '''
+        Schedules ``url`` to be fetched on the download threads. Returns a future of the result of ``fetch(url)``,
+        where ``fetch`` defaults to ``self.fetch``.
+        '''
+        return self._executor.submit(fetch or self.fetch, url)
+
+    def imap(self, urls, lookahead=64):
+        '''
+        Fetches the images at ``urls`` concurrently, keeping at most ``lookahead`` downloads scheduled ahead of the
+        consumer.
+
+        Yields (url, image) tuples in the same order as ``urls``; image is None for links that failed.
+        '''
+        pending = deque()
+        for url in urls:
+            pending.append((url, self.submit(url)))
+            if len(pending) >= lookahead:
+                url_done, future = pending.popleft()
+                yield url_done, future.result()
+        while pending:
+            url_done, future = pending.popleft()
+            yield url_done, future.result()
+
+    def _get_content(self, url):
+        '''
+        Reads the whole body of ``url``, raising if it takes longer than ``self.deadline`` seconds in total.
+        '''
+        start = time.monotonic()
+        with self.session.get(url, timeout=self.timeout, stream=True) as response:
+            response.raise_for_status()
+            body = BytesIO()
+            for chunk in response.iter_content(64 * 1024):
+                body.write(chunk)
+                if time.monotonic() - start > self.deadline:
+                    raise requests.Timeout('deadline of {}s exceeded'.format(self.deadline))
+            return body.getvalue()
+
+    def _get_image(self, url, max_dim):
+        '''
+        Decodes the body of ``url`` as it arrives, raising if it takes longer than ``self.deadline`` seconds in total.
+        '''
+        start = time.monotonic()
+        with self.session.get(url, timeout=self.timeout, stream=True) as response:
+            response.raise_for_status()
+            def chunks():
+                for chunk in response.iter_content(64 * 1024):
+                    yield chunk
+                    if time.monotonic() - start > self.deadline:
+                        raise requests.Timeout('deadline of {}s exceeded'.format(self.deadline))
+            body = _StreamingBody(chunks())
+            image = self.decode(body, max_dim)
+            # the decoder may stop before the end, but the digest is of the whole body
+            digest = body.digest()
+            # network errors are turned into decoding errors by the decoder, so are raised from here
+            if body.error is not None:
+                raise body.error
+            return digest, image
+
+    def _host_slot(self, url):
+        '''
+        Returns the semaphore limiting the requests in flight to the host of ``url``
+        '''
+        host = urlsplit(url).netloc
+        with self._host_lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self._host_slots[host]
+
+class _StreamingBody():
+    '''
+    A read-only file object over a response body, read from ``chunks`` as the reader gets to them, and hashed as they
+    arrive. Only the start of the body (``head`` bytes) and the last ``window`` bytes before the reader's position are
+    kept, so the whole body is never held in memory. That is enough for the decoders of JPEG, PNG and GIF, which only
+    seek back to their header; reading further back raises an OSError, so the image fails to decode. Decoders which
+    read the whole file at once (e.g. WebP's) still get all of it.
+    '''
+    def __init__(self, chunks, head=64 * 1024, window=256 * 1024):
+        self.error = None
+        self._chunks = chunks
+        self._head_size = head
+        self._window = window
+        self._head = bytearray()
+        # bytes of the body from ``_start`` on
+        self._buffer = bytearray()
+        self._start = 0
+        self._position = 0
+        self._done = False
+        self._sha1 = hashlib.sha1()
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            self._fill()
+            end = self._received()
+        else:
+            self._fill(self._position + size)
+            end = min(self._position + size, self._received())
+        data = self._slice(self._position, end)
+        self._position = max(self._position, end)
+        self._trim()
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence == 2:
+            self._fill(keep=False)
+        base = {0: 0, 1: self._position, 2: self._received()}[whence]
+        self._position = max(base + offset, 0)
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def digest(self):
+        '''
+        Reads the rest of the body, returning the SHA-1 hex digest of all of it
+        '''
+        try:
+            self._fill(keep=False)
+        except Exception: # kept in ``error``
+            pass
+        return self._sha1.hexdigest()
+
+    def _received(self):
+        return self._start + len(self._buffer)
+
+    def _slice(self, start, end):
+        if start >= end:
+            return b''
+        if start >= self._start:
+            return bytes(self._buffer[start-self._start:end-self._start])
+        if end <= len(self._head):
+            return bytes(self._head[start:end])
+        if self._start <= len(self._head):
+            return bytes(self._head[start:self._start]) + bytes(self._buffer[:end-self._start])
+        raise OSError('can only seek back to the first {} or last {} bytes read'.format(self._head_size,
+                                                                                      self._window))
+
+    def _trim(self):
+        '''
+        Drops the bytes more than ``window`` before the reader's position
+        '''
+        drop = self._position - self._window - self._start
+        if drop > 0:
+            del self._buffer[:drop]
+            self._start += drop
+
+    def _fill(self, size=None, keep=True):
+        '''
+        Reads chunks until ``size`` bytes have arrived, or to the end of the body if ``size`` is None. Unless
+        ``keep``, the chunks are only hashed (e.g. for the digest, once the decoder is done).
+        '''
+        while not self._done and (size is None or self._received() < size):
+            try:
+                chunk = next(self._chunks)
+            except StopIteration:
+                self._done = True
+                return
+            except Exception as e:
+                self.error, self._done = e, True
+                raise
+            self._sha1.update(chunk)
+            if len(self._head) < self._head_size:
+                self._head += chunk[:self._head_size - len(self._head)]
+            if keep:
+                self._buffer += chunk
+            else:
+                self._start += len(self._buffer) + len(chunk)
+                self._buffer = bytearray()
+
+def _draft_size(size, max_dim):
+    '''
+    The size to ask the JPEG decoder for (``Image.draft``), so an image of ``size`` comes out with its largest
+    dimension no smaller than ``max_dim``
+    '''
+    width, height = size
+    factor = max_dim / max(width, height)
+    if factor >= 1:
+        return size
+    return max(int(math.ceil(width * factor)), 1), max(int(math.ceil(height * factor)), 1)
+
+if __name__ == '__main__':
+    # compare against fetching one by one, using a local server which delays every response
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    image_bytes = BytesIO()
+    Image.new('RGB', (640, 480), (129, 105, 94)).save(image_bytes, 'JPEG')
+
+    class SlowImageHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        def do_GET(self):
+            time.sleep(0.1)
+            body = image_bytes.getvalue()
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/jpeg')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), SlowImageHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    urls = ['http://127.0.0.1:{}/{}.jpg'.format(server.server_port, i) for i in range(100)]
+
+    with ImageDownloader(max_workers=16, max_per_host=16) as downloader:
+        start = time.monotonic()
+        serial = [downloader.fetch(url) for url in urls]
+        serial_time = time.monotonic() - start
+
+        start = time.monotonic()
+        concurrent = [image for _, image in downloader.imap(urls)]
+        concurrent_time = time.monotonic() - start
+
+    assert all(image is not None for image in serial + concurrent)
+    print('serial: %.2fs, concurrent: %.2fs' % (serial_time, concurrent_time))
+    server.shutdown()
@@ -0,0 +1,110 @@
+'''
+Created on 18 Oct 2026
+
+@author: pingshiyu
+'''
+'''
+Content-addressed cache of face encodings, so re-running the encoder only pushes new or changed faces through the
+network.
+
+Encodings are looked up by the sha1 of the square face image. The cache is kept in a folder named after a
+fingerprint of everything else the encoding depends on - the network definition and weights, the ``data_mean`` and
+the output layer - so when any of those change the old encodings are simply not found, rather than being returned
+stale.
+
+Each fingerprint's folder is a FeatureStore (see feature_store.py) of the encodings, plus keys.bin holding the
+20 byte image digest of each row.
+'''
+import hashlib
+import os
+
+import numpy as np
+
+from feature_store import FeatureStore
+
+DIGEST_SIZE = 20
+
+class EmbeddingCache():
+    def __init__(self, root, fingerprint, width=4096):
+        '''
+        root: folder the caches are kept in
+        fingerprint: String, identifying the encoder (see ``encoder_fingerprint``)
+        width: number of features in an encoding
+        '''
+        self.path = os.path.join(root, fingerprint)
+        self.store = FeatureStore(self.path, width=width, label_names=[])
+        self._keys_path = os.path.join(self.path, 'keys.bin')
+
+        keys = b''
+        if os.path.exists(self._keys_path):
+            with open(self._keys_path, 'rb') as f:
+                keys = f.read()
+        # keys are written after their rows, so a crash can only leave rows without keys. They are dropped, so the
+        # rows of keys added later are the next rows of the store.
+        num_keys = min(len(keys) // DIGEST_SIZE, len(self.store))
+        with open(self._keys_path, 'ab') as f:
+            f.truncate(num_keys * DIGEST_SIZE)
+        self.store.truncate(num_keys)
+        self._rows = {keys[i*DIGEST_SIZE:(i+1)*DIGEST_SIZE]: i for i in range(num_keys)}
+        self.hits, self.misses = 0, 0
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, digest):
+        return digest in self._rows
+
+    def missing(self, digests):
+        '''
+        Returns the indices of ``digests`` which are not in the cache, counting hits and misses
+        '''
+        missing = [i for i, digest in enumerate(digests) if digest not in self._rows]
+        self.misses += len(missing)
+        self.hits += len(digests) - len(missing)
+        return missing
+
+    def add(self, digests, encodings):
+        '''
+        Adds the ``encodings`` (array of shape (n, width)) of the images with ``digests``
+        '''
+        new, seen = [], set()
+        for i, digest in enumerate(digests):
+            if digest not in self._rows and digest not in seen:
+                new.append(i); seen.add(digest)
+        if not new:
+            return
+        start = len(self.store)
+        self.store.append(np.asarray(encodings)[new], np.zeros((len(new), 0)))
+        with open(self._keys_path, 'ab') as f:
+            for row, i in enumerate(new, start):
+                f.write(digests[i])
+                self._rows[digests[i]] = row
+
+    def get(self, digests):
+        '''
+        Returns the encodings of the images with ``digests`` as an array of shape (n, width). All must be cached.
+        '''
+        rows = [self._rows[digest] for digest in digests]
+        return np.asarray(self.store.features()[rows])
+
+def image_digest(image):
+    '''
+    Returns the sha1 digest of the contents of the numpy ``image``
+    '''
+    return hashlib.sha1(np.ascontiguousarray(image).data).digest()
+
+def encoder_fingerprint(model_path, weights_path, data_mean, output_layer, extra=''):
+    '''
+    Returns a hex string identifying an encoder by its network definition and weights (hashed by content), its
+    ``data_mean`` and ``output_layer``. ``extra`` is anything else which changes the encodings, e.g. a version of the
+    preprocessing.
+    '''
+    fingerprint = hashlib.sha1()
+    for path in (model_path, weights_path):
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                fingerprint.update(block)
+    fingerprint.update(np.asarray(data_mean, dtype=np.float64).tobytes())
+    fingerprint.update(output_layer.encode())
+    fingerprint.update(extra.encode())
+    return fingerprint.hexdigest()
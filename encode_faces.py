@@ -3,19 +3,22 @@ Created on 6 Dec 2017
 
 @author: pingshiyu
 '''
-import glob
-import pickle
-from vgg_encoder import VGG_Encoder
+import os
+import time
+import multiprocessing
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from vgg_encoder import VGG_Encoder, vgg_fingerprint
+from shard_database import ShardDatabase
+from feature_store import FeatureStore
+from embedding_cache import EmbeddingCache, image_digest
+from prefetch import BatchPrefetcher
+from metrics import METRICS, MetricsExporter
 
-from pandas import DataFrame
 import numpy as np
 
-# create logger
 import logging
-logging.basicConfig(filename = './logs/encode_faces.log',
-                    level = logging.DEBUG,
-                    filemode = 'w+',
-                    format = '%(asctime)s %(message)s')
 
 # locations male and female batches are stored
 images_root = './images/database_square/'
@@ -24,55 +27,153 @@ female_location = images_root + 'female/'
 
 # location to store the data
 data_root = './data/vgg_encoded/'
-male_csv_location = data_root + 'male.csv'
-female_csv_location = data_root + 'female.csv'
+male_store_location = data_root + 'male/'
+female_store_location = data_root + 'female/'
+# encodings of every face seen so far, by image and encoder
+cache_location = data_root + 'cache/'
 
 # grab the batch of images for testing
 mean_male = np.array([149, 112, 98])
 mean_female = np.array([151, 116, 103])
 
-def encode_faces_to_csv(path, mean, csvpath):
+def encode_faces_to_store(path, mean, store_path, dtype='float32', cache_root=cache_location,
+                          batch_size=25, memory_budget=256 * 1024**2, workers=1, threads=None, backend='caffe'):
     '''
     Encode faces in the specified ``path`` with initialising the network to ``mean``
-    Faces will be stored in batch files, which are Pickled lists of (image, [rating, age]) tuples
-    path, csvpath: String
+    Faces are stored in a shard database (see shard_database.py) of images and their [rating, age] features
+    The encodings are saved to the feature store (see feature_store.py) at ``store_path``, replacing what was there.
+    Faces already encoded by the same network (in the cache at ``cache_root``) are not encoded again.
+    path, store_path, cache_root: String
     mean: np array, 1x3 in shape (for VGG)
+    dtype: 'float32' or 'float16', the type the encodings are stored as
+    batch_size: number of faces passed through the network at once
+    memory_budget: maximum bytes of batches loaded ahead of the network
+    workers: number of processes encoding at once, each with its own network
+    threads: number of threads each worker's network may use, by default the library's choice
+    backend: library running the network, see vgg_backends.py
     '''
-    # initialise the VGG-encoder
-    vgg = VGG_Encoder(mean)
+    database = ShardDatabase(path)
+    cache = EmbeddingCache(cache_root, vgg_fingerprint(mean, backend=backend))
+    
+    digests = _image_digests(database)
+    missing = cache.missing(digests)
+    logging.info('{} of {} faces to encode'.format(len(missing), len(database)))
+    if workers == 1:
+        vgg = VGG_Encoder(mean, backend=backend, threads=threads)
+        _vgg_encode_missing(vgg, cache, database, digests, missing, batch_size, memory_budget)
+    else:
+        _vgg_encode_parallel(path, mean, cache, digests, missing, batch_size, workers, threads, backend)
     
-    # loop through files stored in path and save to .csv part by part
-    for filepath in glob.glob(path + '*'):
-        encoded_data = DataFrame(_vgg_encode_file(vgg, filepath))
-        encoded_data.to_csv(csvpath, mode='a')
-        logging.info('successfully saved batch {} to {}'.format(filepath, csvpath))
+    # loop through the shards stored in path and save to the store part by part. The store is written from the
+    # cache in the database's order, however the encoding was split up
+    store = FeatureStore(store_path, width=4096, dtype=dtype, overwrite=True)
+    # kept with the encodings, as faces to predict on must be encoded with the same mean
+    store.update_meta(data_mean=np.asarray(mean, dtype=np.float64).tolist())
+    for shard in range(database.num_shards):
+        _, features = database.shard(shard)
+        start = shard * database.shard_size
+        with METRICS.timer('write', items=len(features)):
+            store.append(cache.get(digests[start:start+len(features)]), features)
+        logging.info('successfully saved shard {} of {} to {}'.format(shard, path, store_path))
+    logging.info('{} faces taken from the cache, {} encoded'.format(cache.hits, cache.misses))
     
-def _vgg_encode_file(vgg, filepath):
+def _image_digests(database):
+    '''
+    Returns the ``image_digest`` of every face in ``database``, in order
+    '''
+    return [image_digest(image)
+            for shard in range(database.num_shards)
+            for image in database.shard(shard)[0]]
+
+def _vgg_encode_missing(vgg, cache, database, digests, missing, batch_size, memory_budget):
     '''
-    Given a pickled filepath in the form that VGG-encoder accepts, encodes the faces stored in the file through the
-    VGG network. The Pickled file will be a list of tuples: [(face_image, [rating, age]), ...].
-    Note ``face_image`` must have dimension 224x224x3, as per the dimension VGG was trained on.
+    Encodes the faces of ``database`` which are not already in the cache through the VGG network, adding them to the
+    cache. Batches are read and preprocessed on a background thread while the previous batch goes through the network.
+    Note the images must have dimension 224x224x3, as per the dimension VGG was trained on.
     vgg: VGG_Encoder() object
-    filepath: String
-    
-    Returns a numpy array where the first columns are the the 4096 features; the last columns are the face's rating
-    and age respectively.
+    cache: EmbeddingCache() object for ``vgg``
+    database: ShardDatabase() object
+    digests: the ``image_digest`` of each image in ``database``
+    missing: the indices of the images to encode
     '''
-    with open(filepath, 'rb') as f:
-        data = pickle.load(f)
-        
-    # unzipping the list of tuples
-    images, features = list(zip(*data))
-    images = np.array(images); features = np.array(features)
-    batch_size = images.shape[0]
-    logging.info('batch size for {} is {}'.format(filepath, batch_size))
+    def load(batch):
+        images = np.stack([database[i][0] for i in batch])
+        return batch, vgg.preprocess(images)
     
-    # passing all images through VGG (batching to manage RAM)
-    vgg_encoding = np.vstack([vgg.encode_batch(images[i:i+25]) 
-                              for i in range(0, batch_size, 25)])
+    batches = [missing[i:i+batch_size] for i in range(0, len(missing), batch_size)]
+    # the preprocessed float32 batch, plus the images it was made from
+    batch_bytes = batch_size * int(np.prod(database.image_shape)) * (4 + 1)
+    for batch, data in BatchPrefetcher(load, batches, batch_bytes, memory_budget):
+        with METRICS.timer('encode', items=len(batch)):
+            encodings = vgg.encode_preprocessed(data)
+        cache.add([digests[i] for i in batch], encodings)
+    
+def _vgg_encode_parallel(path, mean, cache, digests, missing, batch_size, workers, threads, backend):
+    '''
+    Encodes the faces of the database at ``path`` at indices ``missing`` with ``workers`` processes, adding them to
+    the cache. Batches are dealt out to the workers as they become free. The throughput of each worker is logged.
+    '''
+    batches = [missing[i:i+batch_size] for i in range(0, len(missing), batch_size)]
     
-    return np.hstack([vgg_encoding, features])
+    # BLAS reads its thread count when loaded, so it must be set in the environment the workers start with
+    thread_vars = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']
+    saved_env = {var: os.environ.get(var) for var in thread_vars}
+    if threads is not None:
+        os.environ.update({var: str(threads) for var in thread_vars})
+    faces, seconds = defaultdict(int), defaultdict(float)
+    start = time.time()
+    try:
+        # spawned rather than forked, so each worker loads its own caffe and BLAS. Workers are started as batches are
+        # handed out, so the environment is only restored once they are done. A worker whose network fails to load
+        # breaks the pool, so BrokenProcessPool is raised here rather than the worker being started again and again
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=_init_worker, initargs=(path, mean, threads, backend)) as pool:
+            futures = [pool.submit(_worker_encode, batch) for batch in batches]
+            for future in as_completed(futures):
+                batch, encodings, pid, elapsed = future.result()
+                cache.add([digests[i] for i in batch], encodings)
+                faces[pid] += len(batch); seconds[pid] += elapsed
+                METRICS.observe('encode', elapsed, items=len(batch))
+    finally:
+        for var, value in saved_env.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+    total_time = time.time() - start
     
+    for pid in sorted(faces):
+        report = 'worker {}: {} faces in {:.1f}s, {:.2f} faces/s'.format(pid, faces[pid], seconds[pid],
+                                                                         faces[pid] / max(seconds[pid], 1e-9))
+        logging.info(report); print(report)
+    report = 'all workers: {} faces in {:.1f}s, {:.2f} faces/s'.format(len(missing), total_time,
+                                                                       len(missing) / max(total_time, 1e-9))
+    logging.info(report); print(report)
+
+# the network and database of a worker process
+_worker = {}
+
+def _init_worker(path, mean, threads, backend):
+    _worker['vgg'] = VGG_Encoder(mean, backend=backend, threads=threads)
+    _worker['database'] = ShardDatabase(path)
+
+def _worker_encode(batch):
+    '''
+    Encodes the faces at indices ``batch`` in a worker. Returns (batch, encodings, worker pid, seconds taken)
+    '''
+    start = time.time()
+    database = _worker['database']
+    images = np.stack([database[i][0] for i in batch])
+    encodings = _worker['vgg'].encode_batch(images)
+    return batch, encodings, os.getpid(), time.time() - start
+
 if __name__ == '__main__':
-    encode_faces_to_csv(female_location, mean_female, female_csv_location)
-    encode_faces_to_csv(male_location, mean_male, male_csv_location)
+    # create logger. Only here, as worker processes import this module and would truncate the log
+    logging.basicConfig(filename = './logs/encode_faces.log',
+                        level = logging.DEBUG,
+                        filemode = 'w+',
+                        format = '%(asctime)s %(message)s')
+    
+    with MetricsExporter(METRICS, './logs/encode_faces.prom', interval=30):
+        encode_faces_to_store(female_location, mean_female, female_store_location)
+        encode_faces_to_store(male_location, mean_male, male_store_location)
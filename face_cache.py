@@ -0,0 +1,185 @@
+'''
+Created on 18 Oct 2026
+
+@author: pingshiyu
+'''
+'''
+On-disk cache of face-finding outcomes, so links seen before (in other posts, or in earlier runs of the scraper)
+neither hit the network nor the face detector again.
+
+Outcomes are stored by the image's content hash, and links map onto the content hash they were downloaded as. An
+outcome is one of:
+- NO_IMAGE: the link is dead or its content is not a usable image
+- NO_FACE: the image contains no face
+- FACE: the largest face, stored as a PNG crop along with its (top, right, bottom, left) bounding box
+
+The cache is a single sqlite file. It is bounded in size: once it is over ``max_bytes`` the least recently used
+entries are evicted.
+'''
+import sqlite3
+import threading
+import time
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+NO_IMAGE, NO_FACE, FACE = 0, 1, 2
+
+# rough on-disk size of a row besides its face crop
+_ROW_OVERHEAD = 128
+
+class FaceCache():
+    def __init__(self, path='./data/face_cache.sqlite', max_bytes=2 * 1024**3, commit_every=100):
+        '''
+        path: location of the sqlite file, created if it does not exist
+        max_bytes: approximate maximum size of the cache
+        commit_every: number of writes between commits to disk
+        '''
+        self.max_bytes = max_bytes
+        self.commit_every = commit_every
+        self.stats = {'url_hits': 0, 'url_misses': 0,
+                      'content_hits': 0, 'content_misses': 0,
+                      'evictions': 0}
+
+        self._lock = threading.Lock()
+        self._uncommitted = 0
+        # the cache is shared by the download threads
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        # ``key`` is either 'url:<link>' or 'sha1:<content hash>'. Link rows only hold the hash they point to.
+        self._db.execute('''CREATE TABLE IF NOT EXISTS outcomes (
+                                key TEXT PRIMARY KEY,
+                                digest TEXT,
+                                outcome INTEGER,
+                                top INTEGER, right INTEGER, bottom INTEGER, left INTEGER,
+                                face BLOB,
+                                size INTEGER,
+                                last_used REAL)''')
+        self._db.execute('CREATE INDEX IF NOT EXISTS outcomes_last_used ON outcomes (last_used)')
+        self._size = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM outcomes').fetchone()[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            self._db.commit()
+            self._db.close()
+
+    def flush(self):
+        '''
+        Commits outstanding writes to disk
+        '''
+        with self._lock:
+            self._db.commit()
+            self._uncommitted = 0
+
+    def lookup_url(self, url):
+        '''
+        Returns the cached outcome for the link ``url`` as an (outcome, face, box) tuple, where face is a numpy array
+        and box is (top, right, bottom, left) for the FACE outcome, and both are None otherwise.
+        Returns None if ``url`` has not been seen.
+        '''
+        with self._lock:
+            row = self._touch('url:' + url)
+            if row is not None and row[1] is not None:
+                # the link's content was an image, fetch its outcome
+                row = self._touch('sha1:' + row[1])
+            self.stats['url_hits' if row is not None else 'url_misses'] += 1
+        return _to_outcome(row)
+
+    def lookup_content(self, digest):
+        '''
+        Returns the cached outcome for the image with content hash ``digest``, in the same form as ``lookup_url``.
+        Returns None if the image has not been seen.
+        '''
+        with self._lock:
+            row = self._touch('sha1:' + digest)
+            self.stats['content_hits' if row is not None else 'content_misses'] += 1
+        return _to_outcome(row)
+
+    def store(self, url, digest, outcome, face=None, box=None):
+        '''
+        Records the ``outcome`` of the link ``url`` whose content hashes to ``digest``. ``digest`` is None if
+        nothing could be downloaded. For the FACE outcome, ``face`` is the face crop (numpy array) and ``box`` its
+        (top, right, bottom, left) bounding box.
+        '''
+        now = time.time()
+        with self._lock:
+            if digest is not None:
+                blob = None
+                if outcome == FACE:
+                    png = BytesIO()
+                    Image.fromarray(face).save(png, 'PNG')
+                    blob = png.getvalue()
+                top, right, bottom, left = box if box is not None else (None,) * 4
+                self._put(('sha1:' + digest, None, outcome, top, right, bottom, left, blob,
+                           _ROW_OVERHEAD + (len(blob) if blob else 0), now))
+            self._put(('url:' + url, digest, NO_IMAGE if digest is None else None,
+                       None, None, None, None, None, _ROW_OVERHEAD + len(url), now))
+            self._evict()
+
+    def link(self, url, digest):
+        '''
+        Records that the link ``url`` has content hashing to ``digest``, whose outcome is already cached
+        '''
+        with self._lock:
+            self._put(('url:' + url, digest, None, None, None, None, None, None, _ROW_OVERHEAD + len(url), time.time()))
+            self._evict()
+
+    def _put(self, row):
+        '''
+        Inserts or replaces ``row``, keeping track of the total size. Lock must be held.
+        '''
+        old = self._db.execute('SELECT size FROM outcomes WHERE key = ?', (row[0],)).fetchone()
+        if old is not None:
+            self._size -= old[0]
+        self._db.execute('INSERT OR REPLACE INTO outcomes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', row)
+        self._size += row[8]
+        self._uncommitted += 1
+        if self._uncommitted >= self.commit_every:
+            self._db.commit()
+            self._uncommitted = 0
+
+    def _touch(self, key):
+        '''
+        Fetches the row for ``key`` and marks it as recently used. Lock must be held.
+        '''
+        row = self._db.execute('SELECT key, digest, outcome, top, right, bottom, left, face FROM outcomes '
+                               'WHERE key = ?', (key,)).fetchone()
+        if row is not None:
+            self._db.execute('UPDATE outcomes SET last_used = ? WHERE key = ?', (time.time(), key))
+        return row
+
+    def _evict(self):
+        '''
+        Removes the least recently used entries until the cache fits in ``max_bytes``. Lock must be held.
+        '''
+        while self._size > self.max_bytes:
+            # evict in chunks to avoid a query per row
+            victims = self._db.execute('SELECT key, size FROM outcomes ORDER BY last_used LIMIT 256').fetchall()
+            if not victims:
+                break
+            for key, size in victims:
+                self._db.execute('DELETE FROM outcomes WHERE key = ?', (key,))
+                self._size -= size
+                self.stats['evictions'] += 1
+                if self._size <= self.max_bytes:
+                    break
+
+def _to_outcome(row):
+    '''
+    Converts a fetched cache row to an (outcome, face, box) tuple, or None for a miss
+    '''
+    if row is None:
+        return None
+    key, digest, outcome, top, right, bottom, left, blob = row
+    if outcome != FACE:
+        return outcome, None, None
+    face = np.asarray(Image.open(BytesIO(blob)).convert('RGB'))
+    return outcome, face, (top, right, bottom, left)
@@ -0,0 +1,191 @@
+'''
+Created on 18 Oct 2026
+
+@author: pingshiyu
+'''
+'''
+Coarse-to-fine face detection. Faces are looked for in two passes:
+- coarse: the whole image, shrunk to a thumbnail of at most ``coarse_dim`` pixels, with a detection threshold lowered
+  so that faint or small faces are still put forward as candidates
+- refine: a square window around each candidate, cut from the full resolution image and resized so the face is
+  about the detector's preferred size, with the normal threshold. Only faces confirmed here are kept.
+
+The detector only ever scans the thumbnail and a few small windows, however large the image is, and the boxes it
+returns are in the coordinates of the full resolution image, so faces can be cropped from it at full quality.
+
+Scanning the thumbnail upsampled, to find faces smaller than the detector's 80px window, costs about 3x a scan at
+its own size. By default it is only done for images where no face was found without upsampling: small faces are
+then left out of images which have a larger face, but the largest face (all the scraper keeps) is the same. On test
+photos at the scraper's sizes, an image with a face of 80px or more in the thumbnail took ~48ms rather than ~100ms
+with the old detector (hog upsampled once on the 400px image), and one with only smaller faces ~128ms rather than
+~88ms, as it is scanned twice. 24 rather than 22 of the 27 faces were found, with fewer false ones.
+
+Two dlib detectors can be used, as in face_recognition:
+- 'hog': histogram of oriented gradients, fast on the CPU, images are scanned one at a time
+- 'cnn': more accurate, much faster on a GPU. Thumbnails and windows are padded to the same size and scanned in
+  batches.
+'''
+import dlib
+import face_recognition
+import numpy as np
+from PIL import Image
+
+class CoarseToFineDetector():
+    def __init__(self,
+                 coarse_dim=400,
+                 coarse_upsample=1,
+                 coarse_threshold=-0.3,
+                 refine_dim=200,
+                 margin=0.5,
+                 model='hog',
+                 batch_size=32,
+                 upsample_all=False):
+        '''
+        coarse_dim: largest dimension of the thumbnail scanned for candidates
+        coarse_upsample: number of times the thumbnail is upsampled, each time letting faces half as large be found
+        upsample_all: whether to scan every thumbnail upsampled, finding all the small faces. By default thumbnails are
+                      first scanned at their own size, and only upsampled if no face was found.
+        coarse_threshold: adjustment of the (hog) detection threshold for candidates, lower gives more candidates
+        refine_dim: size of the square window scanned around each candidate. Candidates take up about
+                    1 / (1 + 2 * ``margin``) of the window, so the default 200 puts them at the 80px the hog
+                    detector looks for.
+        margin: padding around a candidate in its window, as a fraction of the candidate's size
+        model: 'hog' or 'cnn'
+        batch_size: number of images the cnn detector scans at once
+        '''
+        if model not in ('hog', 'cnn'):
+            raise ValueError('unknown face detection model {}, use hog or cnn'.format(model))
+        self.coarse_dim = coarse_dim
+        self.coarse_upsample = coarse_upsample
+        self.coarse_threshold = coarse_threshold
+        self.refine_dim = refine_dim
+        self.margin = margin
+        self.model = model
+        self.batch_size = batch_size
+        self.upsample_all = upsample_all
+        if model == 'hog':
+            self._hog = dlib.get_frontal_face_detector()
+
+    def detect(self, image_arr):
+        '''
+        Finds the faces in the numpy image ``image_arr`` (height, width, 3).
+        Returns a list of their (top, right, bottom, left) boxes in ``image_arr``, largest first
+        '''
+        return self.detect_batch([image_arr])[0]
+
+    def detect_batch(self, images):
+        '''
+        Finds the faces in each of the numpy ``images``, which may have different sizes.
+        Returns a list of (top, right, bottom, left) boxes for each image, largest first
+        '''
+        scales = [min(1.0, self.coarse_dim / max(image.shape[:2])) for image in images]
+        thumbnails = [_resize(image, scale) for image, scale in zip(images, scales)]
+        if self.upsample_all or not self.coarse_upsample:
+            return self._detect(images, scales, thumbnails, self.coarse_upsample)
+
+        faces = self._detect(images, scales, thumbnails, 0)
+        # only the images without a face are scanned for smaller ones
+        retry = [i for i, boxes in enumerate(faces) if not boxes]
+        if retry:
+            found = self._detect([images[i] for i in retry], [scales[i] for i in retry],
+                                 [thumbnails[i] for i in retry], self.coarse_upsample)
+            for i, boxes in zip(retry, found):
+                faces[i] = boxes
+        return faces
+
+    def _detect(self, images, scales, thumbnails, upsample):
+        # coarse pass, on thumbnails
+        candidates = self._coarse(thumbnails, upsample)
+
+        # refine pass, on windows around the candidates cut from the full images
+        windows, owners = [], []
+        for i, (image, scale, boxes) in enumerate(zip(images, scales, candidates)):
+            for t, r, b, l in boxes:
+                side = max(b - t, r - l) / scale * (1 + 2 * self.margin)
+                centre = ((t + b) / 2 / scale, (l + r) / 2 / scale)
+                windows.append((int(centre[0] - side / 2), int(centre[1] - side / 2), max(int(side), 1)))
+                owners.append(i)
+        crops = [_square_window(images[i], *window, dim=self.refine_dim) for i, window in zip(owners, windows)]
+        refined = self._refine(crops)
+
+        faces = [[] for _ in images]
+        for i, (top, left, side), boxes in zip(owners, windows, refined):
+            if not boxes:
+                continue # not a face after all
+            height, width = images[i].shape[:2]
+            scale = side / self.refine_dim
+            t, r, b, l = max(boxes, key=_area)
+            faces[i].append((max(top + int(t * scale), 0), min(left + int(r * scale), width),
+                             min(top + int(b * scale), height), max(left + int(l * scale), 0)))
+        return [_remove_overlaps(boxes) for boxes in faces]
+
+    def _coarse(self, thumbnails, upsample):
+        if self.model == 'hog':
+            candidates = []
+            for thumbnail in thumbnails:
+                rects, _, _ = self._hog.run(thumbnail, upsample, self.coarse_threshold)
+                candidates.append([_css(rect) for rect in rects])
+            return candidates
+        # the cnn detector batches images of the same size, so thumbnails are padded at the bottom and right
+        padded = [_pad(thumbnail, self.coarse_dim) for thumbnail in thumbnails]
+        return face_recognition.batch_face_locations(padded, upsample, self.batch_size)
+
+    def _refine(self, crops):
+        if not crops:
+            return []
+        if self.model == 'hog':
+            return [[_css(rect) for rect in self._hog(crop, 0)] for crop in crops]
+        return face_recognition.batch_face_locations(crops, 0, self.batch_size)
+
+def _css(rect):
+    '''
+    Converts a dlib rectangle to a (top, right, bottom, left) tuple
+    '''
+    return rect.top(), rect.right(), rect.bottom(), rect.left()
+
+def _area(box):
+    t, r, b, l = box
+    return max(b - t, 0) * max(r - l, 0)
+
+def _resize(image, scale):
+    if scale == 1:
+        return image
+    height, width = image.shape[:2]
+    size = (max(int(width * scale), 1), max(int(height * scale), 1))
+    return np.asarray(Image.fromarray(image).resize(size, Image.BILINEAR))
+
+def _pad(image, dim):
+    padded = np.zeros((dim, dim, image.shape[2]), dtype=image.dtype)
+    padded[:image.shape[0], :image.shape[1]] = image
+    return padded
+
+def _square_window(image, top, left, side, dim):
+    '''
+    Cuts the ``side``x``side`` window at (``top``, ``left``) out of ``image``, padding with black where it goes past
+    the edges, and resizes it to ``dim``x``dim``
+    '''
+    height, width = image.shape[:2]
+    window = np.zeros((side, side, image.shape[2]), dtype=image.dtype)
+    t, l = max(top, 0), max(left, 0)
+    b, r = min(top + side, height), min(left + side, width)
+    if b > t and r > l:
+        window[t-top:b-top, l-left:r-left] = image[t:b, l:r]
+    return np.asarray(Image.fromarray(window).resize((dim, dim), Image.BILINEAR))
+
+def _remove_overlaps(boxes, max_overlap=0.5):
+    '''
+    Sorts ``boxes`` largest first, dropping those overlapping a larger box by more than ``max_overlap`` (of the
+    union) - the same face put forward by two candidates
+    '''
+    kept = []
+    for box in sorted(boxes, key=_area, reverse=True):
+        if all(_overlap(box, other) <= max_overlap for other in kept):
+            kept.append(box)
+    return kept
+
+def _overlap(a, b):
+    t, r = max(a[0], b[0]), min(a[1], b[1])
+    bottom, l = min(a[2], b[2]), max(a[3], b[3])
+    intersection = max(bottom - t, 0) * max(r - l, 0)
+    union = _area(a) + _area(b) - intersection
+    return intersection / union if union > 0 else 0.0
@@ -0,0 +1,215 @@
+'''
+Created on 18 Oct 2026
+
+@author: pingshiyu
+'''
+'''
+Staged face-finding pipeline for the scraper:
+    download -> decode/shrink -> detect -> (save, done by the caller)
+
+Downloads and decoding/shrinking run on the downloader's threads, face detection (CPU bound) runs on a pool of
+processes so it scales across cores. At most ``max_pending`` links are in the pipeline at any time, which bounds the
+work queued up between the stages. The detection processes are not forked from the scraper, which has threads
+running, but started afresh, so ``detect`` and what it uses are imported again in them.
+
+Results are handed back in the same order the links went in, so whatever the caller numbers them with (``img_num``)
+is deterministic no matter which stage finishes first.
+
+Images are decoded as they download (see ImageDownloader.fetch_image), JPEGs at reduced scale if ``max_dim`` is
+given.
+
+Repeats are merged while in the pipeline: a link already in it is not fetched again, and an image already being
+searched under another link is not searched again. With a FaceCache, links seen before also skip the pipeline
+entirely, and images seen before under another link skip detection.
+'''
+import multiprocessing
+import threading
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import requests
+
+from face_cache import NO_IMAGE, NO_FACE, FACE
+from metrics import METRICS, DEAD_LINK, CORRUPT_IMAGE, reset_worker_metrics
+
+class FacePipeline():
+    def __init__(self, downloader, prepare, detect, processes=None, max_pending=64, cache=None, max_dim=None):
+        '''
+        downloader: ImageDownloader() object
+        prepare: function taking a downloaded image (or None) to the array passed to ``detect``, or None if the
+                 image is unusable. Runs on the download threads.
+        detect: function taking the output of ``prepare`` to a (face, box) tuple, or None if there is no face. Runs
+                in worker processes, so it must be a picklable (top level) function.
+        processes: number of detection processes, defaults to the number of cores
+        max_pending: maximum number of links in the pipeline at once
+        cache: optional FaceCache() object, to look up and record the outcome of each link
+        max_dim: the smallest largest-dimension ``prepare`` needs, so JPEGs can be decoded at reduced scale (see
+                 ImageDownloader.decode). Decoded in full if None.
+        '''
+        self.downloader = downloader
+        self.prepare = prepare
+        self.detect = detect
+        self.max_pending = max_pending
+        self.cache = cache
+        self.max_dim = max_dim
+        self.stats = {'url_repeats': 0, 'content_repeats': 0}
+        # the detection processes are started on demand, from the download threads. A process forked there could
+        # inherit a lock held by another thread and deadlock, so they are started from a clean server process instead
+        method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        self._pool = ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context(method),
+                                         initializer=reset_worker_metrics)
+        # futures of the links in the pipeline, and of the images being searched for faces, by sha1
+        self._lock = threading.Lock()
+        self._urls = {}
+        self._detecting = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        '''
+        Stops the detection processes
+        '''
+        self._pool.shutdown(wait=True)
+
+    def imap(self, urls):
+        '''
+        Pushes ``urls`` through the pipeline.
+
+        Yields (url, result) tuples in the same order as ``urls``; result is the output of ``detect``, or None if
+        the link was dead or the image could not be prepared.
+        '''
+        pending = deque()
+        for url in urls:
+            pending.append((url, self._submit(url)))
+            if len(pending) >= self.max_pending:
+                url_done, future = pending.popleft()
+                yield url_done, future.result()
+        while pending:
+            url_done, future = pending.popleft()
+            yield url_done, future.result()
+
+    def _submit(self, url):
+        '''
+        Starts ``url`` through the stages. Returns a future of its final result.
+        '''
+        with self._lock:
+            if url in self._urls:
+                self.stats['url_repeats'] += 1
+                return self._urls[url]
+        result = Future()
+
+        if self.cache is not None:
+            cached = self.cache.lookup_url(url)
+            if cached is not None:
+                result.set_result(_from_outcome(cached))
+                return result
+
+        with self._lock:
+            self._urls[url] = result
+        result.add_done_callback(lambda _: self._forget(self._urls, url))
+
+        def on_detected(detection, digest):
+            try:
+                found, metrics = detection.result()
+                METRICS.merge(metrics)
+                if self.cache is not None:
+                    if found is None:
+                        self.cache.store(url, digest, NO_FACE)
+                    else:
+                        self.cache.store(url, digest, FACE, *found)
+                result.set_result(found)
+            except Exception as e:
+                result.set_exception(e)
+            finally:
+                self._forget(self._detecting, digest)
+
+        def on_downloaded(download):
+            try:
+                digest, prepared, cached = download.result()
+                if cached is not None:
+                    result.set_result(_from_outcome(cached))
+                elif prepared is None:
+                    result.set_result(None)
+                else:
+                    with self._lock:
+                        searching = self._detecting.get(digest)
+                        if searching is None:
+                            self._detecting[digest] = result
+                        else:
+                            self.stats['content_repeats'] += 1
+                    if searching is not None:
+                        # the same image under another link: its result is shared
+                        searching.add_done_callback(lambda searching: on_repeat(searching, digest))
+                    else:
+                        detection = self._pool.submit(_detect_with_metrics, self.detect, prepared)
+                        detection.add_done_callback(lambda detection: on_detected(detection, digest))
+            except Exception as e:
+                result.set_exception(e)
+
+        def on_repeat(searching, digest):
+            try:
+                found = searching.result()
+                if self.cache is not None:
+                    self.cache.link(url, digest)
+                result.set_result(found)
+            except Exception as e:
+                result.set_exception(e)
+
+        self.downloader.submit(url, self._download).add_done_callback(on_downloaded)
+        return result
+
+    def _forget(self, futures, key):
+        with self._lock:
+            futures.pop(key, None)
+
+    def _download(self, url):
+        '''
+        The download/decode and shrink stages, ran on the download threads.
+
+        Returns a (digest, prepared, cached) tuple: the content hash of the image, the output of ``prepare`` and the
+        cached outcome of the image if it was seen before.
+        '''
+        try:
+            with METRICS.timer('download'):
+                digest, image = self.downloader.fetch_image(url, self.max_dim)
+        except requests.RequestException as e: # may work on another run, so not cached
+            print('No image found on', url, '({})'.format(type(e).__name__))
+            METRICS.failure('download', DEAD_LINK)
+            return None, None, None
+        if digest is None:
+            METRICS.failure('download', DEAD_LINK)
+
+        # the image is decoded as it downloads, before its hash is known, so only detection is skipped
+        if self.cache is not None and digest is not None:
+            cached = self.cache.lookup_content(digest)
+            if cached is not None:
+                self.cache.link(url, digest)
+                return digest, None, cached
+
+        with METRICS.timer('decode'):
+            prepared = self.prepare(image)
+        if prepared is None:
+            if digest is not None:
+                METRICS.failure('decode', CORRUPT_IMAGE)
+            print('No image found on', url)
+            if self.cache is not None:
+                self.cache.store(url, digest, NO_IMAGE)
+        return digest, prepared, None
+
+def _detect_with_metrics(detect, prepared):
+    '''
+    Runs ``detect`` in a detection process, handing back the metrics it recorded along with its result
+    '''
+    found = detect(prepared)
+    return found, METRICS.take()
+
+def _from_outcome(cached):
+    '''
+    Converts an (outcome, face, box) tuple from the cache into the form ``detect`` returns
+    '''
+    outcome, face, box = cached
+    return (face, box) if outcome == FACE else None
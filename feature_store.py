@@ -0,0 +1,138 @@
+'''
+Created on 18 Oct 2026
+
+@author: pingshiyu
+'''
+'''
+Binary store for the encoded faces, replacing the appended 4096-column CSVs. A store is a folder containing
+- meta.json: row width, dtypes, number of rows and label names, and anything else recorded about the rows (e.g.
+  the ``data_mean`` they were encoded with)
+- features.bin: raw (rows, width) array of float32 (or float16) features
+- labels.bin: raw (rows, 2) float32 array of the labels, [rating, age]
+- groups.npy: optionally, the duplicate group of each row (see similarity_index.py)
+
+Rows are fixed width, so chunks are appended by writing their bytes to the end of the files, and reading is a
+``np.memmap`` of the files: loading a whole store costs nothing until the rows are used.
+'''
+import json
+import os
+
+import numpy as np
+
+LABEL_NAMES = ['rating', 'age']
+
+class FeatureStore():
+    def __init__(self, path, width=None, dtype='float32', label_names=LABEL_NAMES, overwrite=False):
+        '''
+        Opens the store in folder ``path``, creating it if it does not exist.
+        path: String
+        width: number of features per row, needed when creating a store
+        dtype: 'float32' or 'float16', the type features are stored as when creating a store
+        label_names: names of the label columns when creating a store
+        overwrite: whether to empty an existing store in ``path``, along with anything derived from its rows
+        '''
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        if overwrite:
+            for name in ('meta.json', 'features.bin', 'labels.bin', 'groups.npy'):
+                if os.path.exists(os.path.join(path, name)):
+                    os.remove(os.path.join(path, name))
+
+        if os.path.exists(self._file('meta.json')):
+            with open(self._file('meta.json')) as f:
+                self.meta = json.load(f)
+            # drop rows written after the last update of meta.json, they may be incomplete
+            self._truncate()
+        else:
+            if width is None:
+                raise ValueError('no feature store at {}, and no width given to create one'.format(path))
+            self.meta = {'width': width,
+                         'dtype': np.dtype(dtype).name,
+                         'label_names': list(label_names),
+                         'count': 0}
+            self._write_meta()
+
+        self.width = self.meta['width']
+        self.dtype = np.dtype(self.meta['dtype'])
+        self.num_labels = len(self.meta['label_names'])
+
+    def __len__(self):
+        return self.meta['count']
+
+    def append(self, features, labels):
+        '''
+        Appends a chunk of rows to the store
+        features: array of shape (n, width), converted to the store's dtype
+        labels: array of shape (n, number of labels)
+        '''
+        features = np.ascontiguousarray(features, dtype=self.dtype)
+        labels = np.ascontiguousarray(labels, dtype=np.float32)
+        if features.ndim != 2 or features.shape[1] != self.width:
+            raise ValueError('features of shape {} given, store has width {}'.format(features.shape, self.width))
+        if labels.shape != (len(features), self.num_labels):
+            raise ValueError('labels of shape {} given for {} rows'.format(labels.shape, len(features)))
+
+        with open(self._file('features.bin'), 'ab') as f:
+            f.write(features.tobytes())
+        with open(self._file('labels.bin'), 'ab') as f:
+            f.write(labels.tobytes())
+        self.meta['count'] += len(features)
+        self._write_meta()
+
+    def update_meta(self, **meta):
+        '''
+        Stores the keyword arguments in the store's metadata
+        '''
+        self.meta.update(meta)
+        self._write_meta()
+
+    def truncate(self, count):
+        '''
+        Drops the rows after the first ``count``
+        '''
+        if count < len(self):
+            self.meta['count'] = count
+            self._write_meta()
+            self._truncate()
+
+    def features(self, mode='r'):
+        '''
+        Returns the (rows, width) features as a memory-mapped array
+        '''
+        return self._map('features.bin', self.dtype, self.width, mode)
+
+    def labels(self, mode='r'):
+        '''
+        Returns the (rows, number of labels) labels as a memory-mapped array
+        '''
+        return self._map('labels.bin', np.float32, self.num_labels, mode)
+
+    def iter_chunks(self, chunk_size=4096):
+        '''
+        Yields (start, features, labels) for consecutive chunks of up to ``chunk_size`` rows, the arrays being views
+        into the mapped files.
+        '''
+        features, labels = self.features(), self.labels()
+        for start in range(0, len(self), chunk_size):
+            yield start, features[start:start+chunk_size], labels[start:start+chunk_size]
+
+    def _map(self, name, dtype, width, mode):
+        if len(self) == 0:
+            return np.zeros((0, width), dtype=dtype)
+        return np.memmap(self._file(name), dtype=dtype, mode=mode, shape=(len(self), width))
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _write_meta(self):
+        # write then rename, so meta.json on disk is always complete
+        with open(self._file('meta.json.tmp'), 'w') as f:
+            json.dump(self.meta, f)
+        os.replace(self._file('meta.json.tmp'), self._file('meta.json'))
+
+    def _truncate(self):
+        for name, row_bytes in (('features.bin', np.dtype(self.meta['dtype']).itemsize * self.meta['width']),
+                                ('labels.bin', 4 * len(self.meta['label_names']))):
+            if os.path.exists(self._file(name)):
+                with open(self._file(name), 'r+b') as f:
+                    f.truncate(self.meta['count'] * row_bytes)
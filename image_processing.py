@@ -9,8 +9,6 @@ Image processing functions. Functions in this file include:
 - square_resize(image, dim): resizes image to square of dimension ``dim``
 - average_intensity(image): calculates the average value for each channel in the image
 '''
-# image loading
-from scipy.ndimage import imread
 import numpy as np
 from PIL import Image
 
@@ -38,7 +36,7 @@ def resize_to_square(image, dim=224, background=(129, 105, 94)):
     image_pil = Image.fromarray(image)
     # resize so largest dimension is size ``dim``
     new_w, new_h = int(width * resize_ratio), int(height * resize_ratio)
-    image_resized = image_pil.resize((new_w, new_h), Image.ANTIALIAS)
+    image_resized = image_pil.resize((new_w, new_h), Image.LANCZOS)
         
     # put image onto the background
     image_square = Image.new('RGB', (dim, dim), background)
@@ -48,6 +46,6 @@ def resize_to_square(image, dim=224, background=(129, 105, 94)):
     return np.asarray(image_square)
 
 if __name__ == '__main__':
-    image = imread('./ak.png')
+    image = np.asarray(Image.open('./ak.png').convert('RGB'))
     image_resized = resize_to_square(image, dim=331)
     
\ No newline at end of file
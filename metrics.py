@@ -0,0 +1,275 @@
+'''
+Created on 18 Oct 2026
+
+@author: pingshiyu
+'''
+'''
+Per-stage metrics shared by the scraper, squarer and encoder. Each stage of a run (download, decode, detect, save,
+square, encode, write) has
+- a count of the items through it, and a histogram of how long they took
+- counts of its failures, by category: DEAD_LINK, CORRUPT_IMAGE, NO_FACE, ARRAY_ERROR
+
+Stages record into the module's ``METRICS``, e.g.
+
+    with METRICS.timer('detect'):
+        ...
+    METRICS.failure('detect', NO_FACE)
+
+Work done in worker processes is recorded in the worker's own ``METRICS``, which the worker hands back with its
+results (``take``) for the main process to ``merge``. Worker pools are started with ``reset_worker_metrics`` as
+their initializer, so that what the main process had recorded before is not counted again.
+
+``MetricsExporter`` writes the metrics to a file every few seconds, as Prometheus text (.prom) or JSON (.json). For
+finding where the time goes within a stage, ``enable_profiling`` runs cProfile over some of its calls in this
+process, and ``dump_profiles`` writes the stats for pstats or snakeviz.
+'''
+import cProfile
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+# failure categories
+DEAD_LINK = 'dead_link'
+CORRUPT_IMAGE = 'corrupt_image'
+NO_FACE = 'no_face'
+ARRAY_ERROR = 'array_error'
+
+# upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+
+class Metrics():
+    def __init__(self, prefix='judgementalnet'):
+        '''
+        prefix: start of the metric names in the Prometheus export
+        '''
+        self.prefix = prefix
+        self.start = time.time()
+        self._lock = threading.Lock()
+        self._items = {}
+        self._failures = {}
+        self._histograms = {}
+        self._sums = {}
+        # profiling, off unless enabled
+        self._profiles = {}
+        self._profile_every = {}
+        self._calls = {}
+        self._profiling = False
+
+    def count(self, stage, items=1):
+        '''
+        Counts ``items`` through ``stage``, without timing them
+        '''
+        with self._lock:
+            self._items[stage] = self._items.get(stage, 0) + items
+
+    def failure(self, stage, category):
+        '''
+        Counts a failure of ``category`` (e.g. NO_FACE) in ``stage``
+        '''
+        with self._lock:
+            self._failures[stage, category] = self._failures.get((stage, category), 0) + 1
+
+    def observe(self, stage, seconds, items=1):
+        '''
+        Records ``items`` going through ``stage`` in ``seconds``
+        '''
+        with self._lock:
+            if stage not in self._histograms:
+                self._histograms[stage] = np.zeros(len(BUCKETS), dtype=np.int64)
+                self._sums[stage] = 0.0
+            self._histograms[stage][np.searchsorted(BUCKETS, seconds)] += 1
+            self._sums[stage] += seconds
+            self._items[stage] = self._items.get(stage, 0) + items
+
+    @contextmanager
+    def timer(self, stage, items=1):
+        '''
+        Times the ``with`` block as ``items`` going through ``stage``, profiling it if enabled for ``stage``
+        '''
+        profile = self._start_profile(stage)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            if profile is not None:
+                self._stop_profile(profile)
+            self.observe(stage, elapsed, items)
+
+    def snapshot(self):
+        '''
+        Returns the metrics so far as plain, picklable data
+        '''
+        with self._lock:
+            return {'items': dict(self._items),
+                    'failures': dict(self._failures),
+                    'histograms': {stage: counts.copy() for stage, counts in self._histograms.items()},
+                    'sums': dict(self._sums)}
+
+    def take(self):
+        '''
+        Returns the ``snapshot`` of the metrics so far and starts again from zero, e.g. in a worker process handing
+        its metrics back with its results
+        '''
+        with self._lock:
+            snapshot = {'items': self._items, 'failures': self._failures,
+                        'histograms': self._histograms, 'sums': self._sums}
+            self._items, self._failures, self._histograms, self._sums = {}, {}, {}, {}
+            return snapshot
+
+    def merge(self, snapshot):
+        '''
+        Adds the metrics of ``snapshot`` (from ``take``, usually of another process) to these
+        '''
+        with self._lock:
+            for stage, items in snapshot['items'].items():
+                self._items[stage] = self._items.get(stage, 0) + items
+            for key, failures in snapshot['failures'].items():
+                self._failures[key] = self._failures.get(key, 0) + failures
+            for stage, counts in snapshot['histograms'].items():
+                if stage not in self._histograms:
+                    self._histograms[stage] = np.zeros(len(BUCKETS), dtype=np.int64)
+                    self._sums[stage] = 0.0
+                self._histograms[stage] += counts
+                self._sums[stage] += snapshot['sums'][stage]
+
+    def summary(self):
+        '''
+        Returns a dict by stage of the items, rate (items per second since the metrics started), latency count,
+        mean and estimated p50/p90/p99 (seconds), and failures by category
+        '''
+        snapshot = self.snapshot()
+        elapsed = max(time.time() - self.start, 1e-9)
+        stages = set(snapshot['items']) | {stage for stage, _ in snapshot['failures']}
+        summary = {}
+        for stage in sorted(stages):
+            entry = {'items': snapshot['items'].get(stage, 0),
+                     'rate': snapshot['items'].get(stage, 0) / elapsed,
+                     'failures': {category: n for (failed_stage, category), n in snapshot['failures'].items()
+                                  if failed_stage == stage}}
+            counts = snapshot['histograms'].get(stage)
+            if counts is not None and counts.sum():
+                entry['latency'] = {'count': int(counts.sum()),
+                                    'mean': snapshot['sums'][stage] / counts.sum(),
+                                    'p50': _quantile(counts, 0.5),
+                                    'p90': _quantile(counts, 0.9),
+                                    'p99': _quantile(counts, 0.99)}
+            summary[stage] = entry
+        return summary
+
+    def to_json(self):
+        return json.dumps({'time': time.time(), 'start': self.start, 'stages': self.summary()}, indent=1)
+
+    def to_prometheus(self):
+        '''
+        Returns the metrics in the Prometheus text exposition format
+        '''
+        snapshot = self.snapshot()
+        name = self.prefix + '_stage'
+        lines = ['# TYPE {}_items_total counter'.format(name)]
+        lines += ['{}_items_total{{stage="{}"}} {}'.format(name, stage, items)
+                  for stage, items in sorted(snapshot['items'].items())]
+        lines.append('# TYPE {}_failures_total counter'.format(name))
+        lines += ['{}_failures_total{{stage="{}",category="{}"}} {}'.format(name, stage, category, failures)
+                  for (stage, category), failures in sorted(snapshot['failures'].items())]
+        lines.append('# TYPE {}_seconds histogram'.format(name))
+        for stage, counts in sorted(snapshot['histograms'].items()):
+            for bound, cumulative in zip(BUCKETS, np.cumsum(counts)):
+                le = '+Inf' if bound == float('inf') else repr(float(bound))
+                lines.append('{}_seconds_bucket{{stage="{}",le="{}"}} {}'.format(name, stage, le, cumulative))
+            lines.append('{}_seconds_sum{{stage="{}"}} {}'.format(name, stage, snapshot['sums'][stage]))
+            lines.append('{}_seconds_count{{stage="{}"}} {}'.format(name, stage, counts.sum()))
+        return '\n'.join(lines) + '\n'
+
+    def enable_profiling(self, stages, every=1):
+        '''
+        Profiles one in every ``every`` timed calls of each of ``stages`` with cProfile. Only calls in this process
+        are profiled, and only one call at a time (calls made meanwhile on other threads are skipped).
+        '''
+        for stage in stages:
+            self._profile_every[stage] = every
+            self._profiles.setdefault(stage, cProfile.Profile())
+
+    def dump_profiles(self, folder):
+        '''
+        Writes the profile of each profiled stage to ``folder``/<stage>.prof
+        '''
+        os.makedirs(folder, exist_ok=True)
+        with self._lock:
+            for stage, profile in self._profiles.items():
+                profile.dump_stats(os.path.join(folder, '{}.prof'.format(stage)))
+
+    def _start_profile(self, stage):
+        if stage not in self._profile_every:
+            return None
+        with self._lock:
+            self._calls[stage] = self._calls.get(stage, 0) + 1
+            if self._profiling or (self._calls[stage] - 1) % self._profile_every[stage]:
+                return None
+            self._profiling = True
+        profile = self._profiles[stage]
+        profile.enable()
+        return profile
+
+    def _stop_profile(self, profile):
+        profile.disable()
+        with self._lock:
+            self._profiling = False
+
+class MetricsExporter():
+    def __init__(self, metrics, path, interval=30, format=None):
+        '''
+        Writes ``metrics`` to ``path`` every ``interval`` seconds on a background thread, and when closed.
+        format: 'prometheus' or 'json', by default 'json' if ``path`` ends in .json and 'prometheus' otherwise
+        '''
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.format = format or ('json' if path.endswith('.json') else 'prometheus')
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self):
+        text = self.metrics.to_json() if self.format == 'json' else self.metrics.to_prometheus()
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        # write then rename, so a reader never sees a half written file
+        with open(self.path + '.tmp', 'w') as f:
+            f.write(text)
+        os.replace(self.path + '.tmp', self.path)
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self.write()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.write()
+
+def _quantile(counts, q):
+    '''
+    Estimates the ``q`` quantile of a histogram of ``BUCKETS`` as the upper bound of the bucket it falls in
+    '''
+    index = int(np.searchsorted(np.cumsum(counts), q * counts.sum()))
+    return BUCKETS[min(index, len(BUCKETS) - 1)]
+
+# the metrics of this process
+METRICS = Metrics()
+
+def reset_worker_metrics():
+    '''
+    Starts the ``METRICS`` of a worker process from zero. Passed as the ``initializer`` of worker pools, as a forked
+    worker would otherwise hand back the counts it inherited from the main process along with its own.
+    '''
+    METRICS.take()
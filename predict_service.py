@@ -0,0 +1,305 @@
+'''
+Created on 18 Oct 2026
+
+@author: pingshiyu
+'''
+'''
+Long-lived rating predictor for new photos, served over local HTTP.
+
+A photo goes through the same steps as the training data: the largest face is found and cropped (as in
+save_faces.py), squared (image_processing.resize_to_square), encoded by VGG (vgg_encoder.py), optionally reduced
+(reduce_features.py), then scaled and regressed by a model from regression_train.py.
+
+Finding the face is done on the thread handling the request, one request at a time as the dlib detector can't be used
+by several threads at once. The faces of concurrent requests are then grouped into
+micro-batches for the network: a batch goes through as soon as it is full, or ``max_wait`` seconds after its first
+face arrived, whichever is first. This bounds the latency added by batching while still batching under load.
+
+Endpoints of ``serve``:
+- POST /predict, with the image file as the body: replies {"rating": ..., "age": ..., "box": [t, r, b, l]}, or
+  status 422 if no face is found, 400 if the body is not an image and 500 if the prediction failed
+- GET /stats: numbers of requests and batches, and the mean batch size
+
+``load_test`` sends concurrent requests to a running service and reports the p50/p99 latency and the throughput.
+'''
+import json
+import threading
+import time
+import urllib.request
+import urllib.error
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from queue import Queue, Empty
+
+import numpy as np
+
+from downloader import ImageDownloader
+from image_processing import resize_to_square
+from regression_train import load_model
+from vgg_encoder import VGG_Encoder, MODEL_PATH, WEIGHTS_PATH
+
+class MicroBatcher():
+    def __init__(self, process_batch, max_batch=16, max_wait=0.01):
+        '''
+        Groups items submitted from any thread into batches, processed one batch at a time on a background thread.
+        process_batch: function taking a list of items to the list of their results
+        max_batch: most items in a batch
+        max_wait: most seconds a batch waits for more items after its first item arrives
+        '''
+        self.process_batch = process_batch
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.stats = {'items': 0, 'batches': 0}
+        self._queue = Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, item):
+        '''
+        Queues ``item`` for the next batch. Returns a future of its result.
+        '''
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def close(self):
+        '''
+        Processes the items already queued, then stops the batching thread
+        '''
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch, closing = [first], False
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                try:
+                    entry = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except Empty:
+                    break
+                if entry is None:
+                    closing = True
+                    break
+                batch.append(entry)
+            self._process([item for item, _ in batch], [future for _, future in batch])
+            if closing:
+                return
+
+    def _process(self, items, futures):
+        try:
+            results = self.process_batch(items)
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+            return
+        self.stats['items'] += len(items)
+        self.stats['batches'] += 1
+        for future, result in zip(futures, results):
+            future.set_result(result)
+
+class RatingPredictor():
+    def __init__(self,
+                 model_path,
+                 data_mean=None,
+                 target_models=('rating', 'age'),
+                 reducer_path=None,
+                 vgg_model_path=MODEL_PATH,
+                 vgg_weights_path=WEIGHTS_PATH,
+                 backend='caffe',
+                 threads=None,
+                 dim=224,
+                 max_batch=16,
+                 max_wait=0.01,
+                 find_face=None):
+        '''
+        model_path: a model pickled by regression_train.save_model
+        data_mean: the mean pixel values the faces the model was trained on were encoded with, by default the one
+                   saved with the model. Only needed for models trained before it was saved.
+        target_models: the targets of the model to predict
+        reducer_path: the reduced store (see reduce_features.py) the model was trained on, if it was trained on
+                      reduced features
+        backend, threads: as for VGG_Encoder
+        dim: size of the squared faces the network takes
+        max_batch, max_wait: most faces encoded at once, and most seconds a face waits for others to batch with
+        find_face: function taking a decoded PIL image to (face as a numpy array, (top, right, bottom, left)), or
+                   None if there is no face. By default the detection of save_faces.py.
+        '''
+        self.model = load_model(model_path)
+        if data_mean is None:
+            data_mean = self.model.get('data_mean')
+            if data_mean is None:
+                raise ValueError('no data_mean saved with the model {}, one must be given'.format(model_path))
+        self.target_models = target_models
+        self.reducer = None
+        if reducer_path is not None:
+            from reduce_features import load_reducer
+            self.reducer = load_reducer(reducer_path)
+        self.vgg = VGG_Encoder(data_mean, vgg_model_path, vgg_weights_path, backend=backend, threads=threads)
+        self.dim = dim
+        self.find_face = find_face if find_face is not None else _find_face
+        self.stats = {'requests': 0, 'no_face': 0, 'not_image': 0}
+        self._stats_lock = threading.Lock()
+        self._batcher = MicroBatcher(self._predict_batch, max_batch, max_wait)
+
+    def predict(self, content):
+        '''
+        Predicts the targets for the largest face in the image file ``content`` (bytes). Safe to call from many
+        threads at once; faces are batched together for the network.
+
+        Returns a dict of the predicted targets and the face's 'box' (top, right, bottom, left), or None if there is
+        no face. Raises ValueError if ``content`` is not an image.
+        '''
+        self._count('requests')
+        image = ImageDownloader.decode(content)
+        if image is None:
+            self._count('not_image')
+            raise ValueError('not an image')
+        found = self.find_face(image.convert('RGB'))
+        if found is None:
+            self._count('no_face')
+            return None
+        face, box = found
+        prediction = self._batcher.submit(resize_to_square(np.ascontiguousarray(face), dim=self.dim)).result()
+        return dict(prediction, box=[int(x) for x in box])
+
+    def batch_stats(self):
+        '''
+        Returns the numbers of requests, of faces and batches through the network, and the mean batch size
+        '''
+        stats = dict(self.stats, **self._batcher.stats)
+        stats['mean_batch'] = stats['items'] / max(stats['batches'], 1)
+        return stats
+
+    def close(self):
+        self._batcher.close()
+
+    def _predict_batch(self, faces):
+        features = self.vgg.encode_batch(np.stack(faces))
+        if self.reducer is not None:
+            features = self.reducer.transform(features)
+        X = self.model['scaler'].transform(np.asarray(features, dtype=np.float64))
+        predictions = {target: self.model[target].predict(X) for target in self.target_models}
+        return [{target: float(predictions[target][i]) for target in self.target_models} for i in range(len(faces))]
+
+    def _count(self, stat):
+        with self._stats_lock:
+            self.stats[stat] += 1
+
+# the scraper's detector is shared by the request threads, and dlib's detectors are not thread safe
+_detect_lock = threading.Lock()
+
+def _find_face(image):
+    '''
+    The face detection of the scraper: the image is shrunk, and the largest face found and cropped
+    '''
+    from save_faces import _prepare_image, _detect_face
+    image_arr = _prepare_image(image)
+    if image_arr is None:
+        return None
+    with _detect_lock:
+        return _detect_face(image_arr)
+
+class _PredictServer(ThreadingHTTPServer):
+    # the default backlog of 5 makes bursts of connections wait a second to be retried
+    request_queue_size = 128
+    daemon_threads = True
+
+def serve(predictor, host='127.0.0.1', port=8008):
+    '''
+    Starts serving ``predictor`` over HTTP on a background thread (see the endpoints above).
+    Returns the server; ``server.shutdown()`` stops it.
+    '''
+    class PredictHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            if self.path != '/predict':
+                return self._reply(404, {'error': 'unknown path'})
+            content = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            try:
+                prediction = predictor.predict(content)
+            except ValueError as e:
+                return self._reply(400, {'error': str(e)})
+            except Exception as e: # e.g. the batch failed in the network
+                return self._reply(500, {'error': '{}: {}'.format(type(e).__name__, e)})
+            if prediction is None:
+                return self._reply(422, {'error': 'no face found'})
+            self._reply(200, prediction)
+
+        def do_GET(self):
+            if self.path != '/stats':
+                return self._reply(404, {'error': 'unknown path'})
+            self._reply(200, predictor.batch_stats())
+
+        def _reply(self, status, body):
+            body = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = _PredictServer((host, port), PredictHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def load_test(url, bodies, num_requests=500, concurrency=16):
+    '''
+    POSTs ``num_requests`` requests to ``url``, ``concurrency`` at a time, cycling through the image files
+    ``bodies`` (a list of bytes).
+
+    Returns a dict of the 'p50' and 'p99' latency (seconds), 'throughput' (requests per second) and the count of
+    each response 'status'
+    '''
+    def post(i):
+        request = urllib.request.Request(url, data=bodies[i % len(bodies)], method='POST',
+                                         headers={'Content-Type': 'application/octet-stream'})
+        start = time.monotonic()
+        try:
+            with urllib.request.urlopen(request) as response:
+                response.read()
+                status = response.status
+        except urllib.error.HTTPError as e:
+            status = e.code
+        return time.monotonic() - start, status
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(post, range(num_requests)))
+    total_time = time.monotonic() - start
+
+    latencies = np.array([latency for latency, _ in results])
+    statuses = {}
+    for _, status in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    return {'p50': float(np.percentile(latencies, 50)),
+            'p99': float(np.percentile(latencies, 99)),
+            'throughput': num_requests / total_time,
+            'status': statuses}
+
+if __name__ == '__main__':
+    import glob
+
+    # serve the female model, then load test it with the raw faces scraped earlier
+    predictor = RatingPredictor('./data/models/female.pkl')
+    server = serve(predictor)
+    bodies = []
+    for file in sorted(glob.glob('./images/raw/*.png'))[:50]:
+        with open(file, 'rb') as f:
+            bodies.append(f.read())
+
+    url = 'http://127.0.0.1:{}/predict'.format(server.server_port)
+    for concurrency in (1, 4, 16, 64):
+        report = load_test(url, bodies, num_requests=400, concurrency=concurrency)
+        print('concurrency {}: p50 {:.1f}ms, p99 {:.1f}ms, {:.1f} requests/s, {}'.format(
+            concurrency, report['p50'] * 1000, report['p99'] * 1000, report['throughput'], report['status']))
+    print('batches:', predictor.batch_stats())
+    server.shutdown()
+    predictor.close()
@@ -0,0 +1,83 @@
+'''
+Created on 18 Oct 2026
+
+@author: pingshiyu
+'''
+'''
+Background loading of batches, so the next batch is read and preprocessed while the current one goes through the
+network.
+'''
+import threading
+from queue import Queue, Full
+
+# marks the end of the batches in the queue
+_DONE = object()
+
+class BatchPrefetcher():
+    def __init__(self, load, tasks, batch_bytes, memory_budget=256 * 1024**2):
+        '''
+        Loads a batch for each of ``tasks`` with ``load(task)`` on a background thread, keeping loaded batches in a
+        queue until they are used.
+        load: function taking a task to its batch
+        tasks: iterable of tasks, e.g. the indices of the samples in each batch
+        batch_bytes: (rough) size of a loaded batch, in bytes
+        memory_budget: maximum number of bytes held by loaded batches. At least one batch is always loaded ahead,
+                       so loading overlaps with using the current batch (double buffering).
+        '''
+        self.load = load
+        self.tasks = tasks
+        # one batch is held by the consumer and one is being loaded, the rest can wait in the queue
+        self.depth = max(1, memory_budget // max(batch_bytes, 1) - 2)
+        self._queue = Queue(self.depth)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __iter__(self):
+        '''
+        Yields the loaded batches in the order of ``tasks``. Errors raised while loading are raised here.
+        '''
+        try:
+            while True:
+                batch = self._queue.get()
+                if batch is _DONE:
+                    return
+                if isinstance(batch, _LoadError):
+                    raise batch.error
+                yield batch
+        finally:
+            self.close()
+
+    def close(self):
+        '''
+        Stops loading batches
+        '''
+        self._stop.set()
+        # unblock the loader if it is waiting on a full queue
+        while not self._queue.empty():
+            self._queue.get_nowait()
+        self._thread.join()
+
+    def _run(self):
+        try:
+            for task in self.tasks:
+                if self._stop.is_set():
+                    return
+                self._put(self.load(task))
+        except Exception as e:
+            self._put(_LoadError(e))
+            return
+        self._put(_DONE)
+
+    def _put(self, item):
+        # wait for room in the queue, giving up if the prefetcher is closed
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except Full:
+                continue
+
+class _LoadError():
+    def __init__(self, error):
+        self.error = error
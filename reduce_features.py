@@ -0,0 +1,160 @@
+'''
+Created on 18 Oct 2026
+
+@author: pingshiyu
+'''
+'''
+Reduces the 4096 VGG features of an encoded store (see feature_store.py) to ``k`` dimensions, between encoding and
+training. The store is read in chunks so it never has to fit in memory:
+- 'pca': incremental PCA, fitted chunk by chunk with ``partial_fit``
+- 'random': sparse random projection, which needs no fitting beyond the number of features
+
+The fitted transform is pickled next to the reduced store (reducer.pkl) so the same transform can be applied to new
+faces later. How much is lost is reported: for PCA the fraction of the variance kept, for random projection (which
+keeps distances rather than variance) the relative error of the distances between a sample of faces.
+'''
+import os
+import pickle
+import logging
+
+import numpy as np
+
+from feature_store import FeatureStore
+
+# location of data stored
+data_root = './data/vgg_encoded/'
+reduced_root = './data/vgg_reduced/'
+
+def fit_reducer(store_path, k=256, method='pca', chunk_size=4096, seed=0):
+    '''
+    Fits a reduction to ``k`` dimensions on the features of the store at ``store_path``, reading ``chunk_size`` rows
+    at a time.
+    method: 'pca' or 'random'
+    Returns the fitted transform (a scikit-learn transformer)
+    '''
+    # scikit-learn is slow to import, so only imported when fitting
+    from sklearn.decomposition import IncrementalPCA
+    from sklearn.random_projection import SparseRandomProjection
+
+    store = FeatureStore(store_path)
+    if method == 'random':
+        reducer = SparseRandomProjection(n_components=k, random_state=seed)
+        # only the number of features is used to build the projection
+        return reducer.fit(np.zeros((1, store.width), dtype=np.float32))
+    if method != 'pca':
+        raise ValueError('unknown reduction {}, use pca or random'.format(method))
+
+    reducer = IncrementalPCA(n_components=k)
+    for start, stop in _chunk_bounds(len(store), max(chunk_size, k)):
+        reducer.partial_fit(np.asarray(store.features()[start:stop], dtype=np.float32))
+        logging.info('fitted pca on rows {} to {}'.format(start, stop))
+    return reducer
+
+def reduce_store(reducer, store_path, reduced_path, chunk_size=4096, sample_size=1000, seed=0):
+    '''
+    Transforms the features of the store at ``store_path`` with ``reducer`` into a new store at ``reduced_path`` with
+    the same labels, reading ``chunk_size`` rows at a time. The reducer is pickled to ``reduced_path``/reducer.pkl.
+
+    Returns a dict of how well the reduced features stand in for the originals:
+    - PCA: 'variance_kept', the fraction of the features' total variance kept
+    - random projection: 'distance_error', the mean relative error of the distances between ``sample_size`` faces
+      picked at random (with ``seed``)
+    '''
+    store = FeatureStore(store_path)
+    k = reducer.transform(np.zeros((1, store.width), dtype=np.float32)).shape[1]
+    reduced = FeatureStore(reduced_path, width=k, dtype=store.dtype, label_names=store.meta['label_names'],
+                           overwrite=True)
+    if 'data_mean' in store.meta:
+        reduced.update_meta(data_mean=store.meta['data_mean'])
+
+    # a random projection keeps distances, not variance (it can even report more variance than there was), so the
+    # variance is only compared for PCA
+    pca = hasattr(reducer, 'explained_variance_')
+    # running sums, for the total variance before and after
+    before, after = _VarianceSum(), _VarianceSum()
+    for _, features, labels in store.iter_chunks(chunk_size):
+        features = np.asarray(features, dtype=np.float32)
+        reduced_features = reducer.transform(features)
+        reduced.append(reduced_features, labels)
+        if pca:
+            before.add(features); after.add(reduced_features)
+
+    with open(os.path.join(reduced_path, 'reducer.pkl'), 'wb') as f:
+        pickle.dump(reducer, f)
+
+    if pca:
+        quality = {'variance_kept': after.total() / before.total() if before.total() > 0 else 1.0}
+        logging.info('reduced {} to {} features, keeping {:.1%} of the variance'.format(
+            store_path, k, quality['variance_kept']))
+    else:
+        sample = np.random.RandomState(seed).permutation(len(store))[:sample_size]
+        sample.sort()
+        quality = {'distance_error': _distance_error(store.features()[sample], reduced.features()[sample])}
+        logging.info('reduced {} to {} features, distances {:.1%} out on average'.format(
+            store_path, k, quality['distance_error']))
+    return quality
+
+def load_reducer(reduced_path):
+    '''
+    Loads the transform saved with the reduced store at ``reduced_path``
+    '''
+    with open(os.path.join(reduced_path, 'reducer.pkl'), 'rb') as f:
+        return pickle.load(f)
+
+class _VarianceSum():
+    '''
+    Accumulates the total variance (sum over columns) of the rows added to it
+    '''
+    def __init__(self):
+        self.n, self.sums, self.squares = 0, 0.0, 0.0
+
+    def add(self, rows):
+        rows = np.asarray(rows, dtype=np.float64)
+        self.n += len(rows)
+        self.sums = self.sums + rows.sum(0)
+        self.squares = self.squares + (rows**2).sum(0)
+
+    def total(self):
+        if self.n == 0:
+            return 0.0
+        mean = self.sums / self.n
+        return float((self.squares / self.n - mean**2).sum())
+
+def _distance_error(features, reduced_features):
+    '''
+    Returns the mean relative error of the distances between the rows of ``reduced_features`` against those between
+    the same rows of ``features``
+    '''
+    original, reduced = _distances(features), _distances(reduced_features)
+    nonzero = original > 0
+    if not nonzero.any():
+        return 0.0
+    return float(np.mean(np.abs(reduced[nonzero] - original[nonzero]) / original[nonzero]))
+
+def _distances(rows):
+    '''
+    Returns the euclidean distances between each pair of ``rows``
+    '''
+    rows = np.asarray(rows, dtype=np.float64)
+    squares = (rows**2).sum(1)
+    distances = squares[:, None] + squares[None, :] - 2 * rows.dot(rows.T)
+    return np.sqrt(np.maximum(distances[np.triu_indices(len(rows), 1)], 0))
+
+def _chunk_bounds(count, chunk_size):
+    '''
+    Returns (start, stop) of consecutive chunks of ``chunk_size`` rows, folding a short last chunk into the one
+    before it (incremental PCA needs at least ``k`` rows at a time)
+    '''
+    starts = list(range(0, count, chunk_size))
+    if len(starts) > 1 and count - starts[-1] < chunk_size:
+        starts.pop()
+    return [(start, stop) for start, stop in zip(starts, starts[1:] + [count])]
+
+if __name__ == '__main__':
+    logging.basicConfig(level = logging.INFO,
+                        format = '%(asctime)s %(message)s')
+
+    for gender in ('female', 'male'):
+        reducer = fit_reducer(data_root + gender + '/', k=256, method='pca')
+        quality = reduce_store(reducer, data_root + gender + '/', reduced_root + gender + '/')
+        print('{}: kept {:.1%} of the variance in 256 dimensions'.format(gender, quality['variance_kept']))
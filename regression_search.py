@@ -0,0 +1,184 @@
+'''
+Created on 18 Oct 2026
+
+@author: pingshiyu
+'''
+'''
+Hyperparameter search for the ElasticNet and Huber regressors on the VGG-encoded faces.
+
+ElasticNet is searched along regularisation paths: for each l1_ratio the alphas are fitted from largest to smallest,
+each fit starting from the previous solution (warm start), on a Gram matrix computed once per fold. Huber is searched
+on a separate (epsilon, alpha) grid. Cross-validation folds (and Huber candidates) run in parallel processes.
+
+The split is the same as regression_train's: the test rows are held out altogether, and the rest are dealt into
+folds by another hash of their index. The fit time and validation metrics of every candidate on every fold are saved
+as JSON, so runs can be compared.
+'''
+import json
+import os
+import time
+import logging
+
+import numpy as np
+
+from feature_store import FeatureStore
+from regression_train import hash_split, hash_unit, split_keys, check_groups, data_root, model_root
+from similarity_index import load_groups
+
+TARGETS = {'rating': 0, 'age': 1}
+
+def load_training_rows(store_path, target='rating', test_size=0.1, seed=0, chunk_size=4096, groups=None):
+    '''
+    Reads the non-test rows of the store at ``store_path`` (the split of regression_train.train_streaming, with
+    the same ``groups``).
+    Returns (X, y, keys) where ``keys`` are the keys the rows were split by, their groups or indices in the store
+    '''
+    store = FeatureStore(store_path)
+    check_groups(groups, store)
+    X, y, keys = [], [], []
+    for start, features, labels in store.iter_chunks(chunk_size):
+        chunk_keys = split_keys(start, start + len(features), groups)
+        train = ~hash_split(chunk_keys, test_size, seed)
+        X.append(np.asarray(features[train], dtype=np.float64))
+        y.append(labels[train][:, TARGETS[target]].astype(np.float64))
+        keys.append(chunk_keys[train])
+    return np.vstack(X), np.concatenate(y), np.concatenate(keys)
+
+def assign_folds(keys, num_folds=5, seed=0):
+    '''
+    Deals rows into ``num_folds`` folds by a hash of their ``keys``, independent of the train/test split. Rows with
+    the same key (group) are in the same fold.
+    '''
+    return np.minimum((hash_unit(keys, seed + 1) * num_folds).astype(int), num_folds - 1)
+
+def search_elasticnet(X, y, folds, alphas=None, l1_ratios=(0.1, 0.5, 0.9, 0.99), num_alphas=20, n_jobs=-1,
+                      max_iter=1000, tol=1e-4):
+    '''
+    Cross-validates ElasticNet over ``alphas`` x ``l1_ratios``, computing a regularisation path with warm starts and
+    a precomputed Gram matrix for each fold. Folds run in parallel on ``n_jobs`` processes.
+    alphas: the alphas to try, by default ``num_alphas`` log-spaced values below the smallest alpha that zeroes all
+            coefficients
+    Returns a list of dicts, one per (fold, l1_ratio, alpha), with the fit time and validation metrics
+    '''
+    # joblib and scikit-learn are slow to import, so only imported when searching
+    from joblib import Parallel, delayed
+    if alphas is None:
+        alphas = _default_alphas(X, y, min(l1_ratios), num_alphas)
+    alphas = np.sort(np.asarray(alphas, dtype=np.float64))[::-1]
+    results = Parallel(n_jobs=n_jobs)(delayed(_elasticnet_fold)(X, y, folds == fold, alphas, l1_ratios,
+                                                                max_iter, tol)
+                                      for fold in np.unique(folds))
+    return [dict(row, fold=int(fold)) for fold, rows in zip(np.unique(folds), results) for row in rows]
+
+def search_huber(X, y, folds, epsilons=(1.1, 1.35, 1.7, 2.0), alphas=(1e-4, 1e-3, 1e-2, 1e-1), n_jobs=-1,
+                 max_iter=500):
+    '''
+    Cross-validates HuberRegressor over the grid ``epsilons`` x ``alphas``. Every (fold, candidate) fit runs in
+    parallel on ``n_jobs`` processes.
+    Returns a list of dicts, one per (fold, epsilon, alpha), with the fit time and validation metrics
+    '''
+    from joblib import Parallel, delayed
+    tasks = [(int(fold), epsilon, alpha) for fold in np.unique(folds) for epsilon in epsilons for alpha in alphas]
+    results = Parallel(n_jobs=n_jobs)(delayed(_huber_fit)(X, y, folds == fold, epsilon, alpha, max_iter)
+                                      for fold, epsilon, alpha in tasks)
+    return [dict(row, fold=fold) for (fold, _, _), row in zip(tasks, results)]
+
+def summarise(results, params):
+    '''
+    Averages ``results`` over the folds for each candidate (the values of ``params``).
+    Returns a list of dicts sorted by mean validation mean squared error, best first
+    '''
+    candidates = {}
+    for row in results:
+        candidates.setdefault(tuple(row[param] for param in params), []).append(row)
+    summary = []
+    for values, rows in candidates.items():
+        entry = dict(zip(params, values))
+        for metric in ('mse', 'mae', 'r2', 'fit_time'):
+            entry[metric] = float(np.mean([row[metric] for row in rows]))
+        summary.append(entry)
+    return sorted(summary, key=lambda entry: entry['mse'])
+
+def save_results(path, **results):
+    '''
+    Saves the search ``results`` (and settings) as JSON to ``path``, stamped with the time of the run
+    '''
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(dict(results, time=time.strftime('%Y-%m-%d %H:%M:%S')), f, indent=1)
+
+def _elasticnet_fold(X, y, validation, alphas, l1_ratios, max_iter, tol):
+    '''
+    Fits the ElasticNet paths on one fold, ``validation`` masking out the validation rows
+    '''
+    from sklearn.linear_model import ElasticNet
+    X_train, y_train = X[~validation], y[~validation]
+    # centre the data ourselves so the intercept can be left out of the fit, and the Gram matrix used as is
+    X_mean, y_mean = X_train.mean(0), y_train.mean()
+    X_train = X_train - X_mean
+    y_train = y_train - y_mean
+    start = time.time()
+    gram = np.dot(X_train.T, X_train)
+    gram_time = time.time() - start
+
+    rows = []
+    for l1_ratio in l1_ratios:
+        model = ElasticNet(l1_ratio=l1_ratio, fit_intercept=False, precompute=gram, warm_start=True,
+                           max_iter=max_iter, tol=tol, copy_X=False)
+        for alpha in alphas:
+            model.set_params(alpha=alpha)
+            start = time.time()
+            model.fit(X_train, y_train)
+            fit_time = time.time() - start
+            prediction = np.dot(X[validation] - X_mean, model.coef_) + y_mean
+            rows.append(dict(_metrics(y[validation], prediction), l1_ratio=l1_ratio, alpha=float(alpha),
+                             fit_time=fit_time, gram_time=gram_time, iterations=int(model.n_iter_),
+                             nonzero=int(np.count_nonzero(model.coef_))))
+    return rows
+
+def _huber_fit(X, y, validation, epsilon, alpha, max_iter):
+    '''
+    Fits one Huber candidate on one fold, ``validation`` masking out the validation rows
+    '''
+    from sklearn.linear_model import HuberRegressor
+    model = HuberRegressor(epsilon=epsilon, alpha=alpha, max_iter=max_iter)
+    start = time.time()
+    model.fit(X[~validation], y[~validation])
+    fit_time = time.time() - start
+    return dict(_metrics(y[validation], model.predict(X[validation])), epsilon=epsilon, alpha=alpha,
+                fit_time=fit_time, iterations=int(model.n_iter_))
+
+def _metrics(y, prediction):
+    error = prediction - y
+    variance = y.var()
+    return {'mse': float((error**2).mean()),
+            'mae': float(np.abs(error).mean()),
+            'r2': float(1 - (error**2).mean() / variance) if variance > 0 else float('nan')}
+
+def _default_alphas(X, y, l1_ratio, num_alphas):
+    '''
+    Log-spaced alphas from the smallest one which zeroes every coefficient, down by a factor of 1000
+    '''
+    X_centred_y = np.dot((X - X.mean(0)).T, y - y.mean())
+    alpha_max = np.abs(X_centred_y).max() / (len(y) * l1_ratio)
+    return np.logspace(np.log10(alpha_max), np.log10(alpha_max * 1e-3), num_alphas)
+
+if __name__ == '__main__':
+    logging.basicConfig(level = logging.INFO,
+                        format = '%(asctime)s %(message)s')
+
+    groups = load_groups(data_root + 'female/')
+    X, y, keys = load_training_rows(data_root + 'female/', target='rating', groups=groups)
+    folds = assign_folds(keys, num_folds=5)
+    logging.info('searching on {} rows of {} features'.format(*X.shape))
+
+    enet_results = search_elasticnet(X, y, folds)
+    huber_results = search_huber(X, y, folds)
+    enet_summary = summarise(enet_results, ('l1_ratio', 'alpha'))
+    huber_summary = summarise(huber_results, ('epsilon', 'alpha'))
+    print('best elasticnet:', enet_summary[0])
+    print('best huber:', huber_summary[0])
+
+    save_results(model_root + 'search_female_rating.json', store=data_root + 'female/', target='rating',
+                 elasticnet=enet_results, huber=huber_results,
+                 elasticnet_summary=enet_summary, huber_summary=huber_summary)
@@ -5,27 +5,167 @@ Created on 7 Dec 2017
 '''
 '''
 Uses Linear Regression on the VGG-encoded faces dataset, and evaluates the trained model.
+
+Training streams the feature store (see feature_store.py) chunk by chunk into incremental estimators, so memory use
+is bounded by the chunk size rather than the size of the dataset. The train/test split is decided by a hash of each
+sample's index, so it is the same on every pass and every run without keeping the split in memory. If the faces
+have been grouped (see similarity_index.py), the hash is of the face's group instead, so the same face posted several
+times is never both trained and tested on.
 '''
-from sklearn.linear_model import ElasticNet, HuberRegressor
-from sklearn.model_selection import train_test_split
-import matplotlib.pyplot as plt
+import os
+import pickle
+
 import numpy as np
-from pandas import read_csv
+from feature_store import FeatureStore
+from similarity_index import load_groups
 
 # location of data stored
 data_root = './data/vgg_encoded/'
-male_csv = data_root + 'male.csv'
-female_csv = data_root + 'female.csv'
+male_store = data_root + 'male/'
+female_store = data_root + 'female/'
+
+# location of trained models
+model_root = './data/models/'
+
+def hash_unit(keys, seed=0):
+    '''
+    Hashes ``keys`` (e.g. the samples' indices) to floats spread uniformly over [0, 1), differently for each ``seed``
+    '''
+    # splitmix64 of the keys
+    with np.errstate(over='ignore'):
+        z = np.asarray(keys, dtype=np.uint64) + np.array(seed + 1, dtype=np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        z = z ^ (z >> np.uint64(31))
+    return (z >> np.uint64(11)).astype(np.float64) / 2.0**53
+
+def hash_split(keys, test_size=0.1, seed=0):
+    '''
+    Decides which samples are in the test set from a hash of their ``keys`` (e.g. the samples' indices).
+    Returns a boolean array, True for test samples; about ``test_size`` of the keys are picked.
+    '''
+    return hash_unit(keys, seed) < test_size
+
+def split_keys(start, stop, groups=None):
+    '''
+    Returns the keys the split is decided by for rows ``start`` to ``stop``: their group in ``groups`` (an array
+    giving each row's group) if given, otherwise their index
+    '''
+    return np.arange(start, stop) if groups is None else groups[start:stop]
+
+def check_groups(groups, store):
+    '''
+    Raises a ValueError if ``groups`` are given but not one for each row of ``store``, e.g. saved before the store
+    was encoded again
+    '''
+    if groups is not None and len(groups) != len(store):
+        raise ValueError('{} groups given for a store of {} rows'.format(len(groups), len(store)))
+
+def train_streaming(store_path, chunk_size=4096, epochs=5, test_size=0.1, seed=0, groups=None, **sgd_params):
+    '''
+    Trains linear models for the rating and age of the faces in the store at ``store_path``, reading ``chunk_size``
+    rows at a time. Features are standardised with a scaler fitted on the training rows, then both models are
+    trained with ``SGDRegressor.partial_fit`` for ``epochs`` passes over the training rows (in a shuffled order of
+    chunks, and of rows within each chunk).
+    groups: optional group of each row (see similarity_index.duplicate_groups), the rows of a group are all put on
+            the same side of the split
+    sgd_params: passed on to SGDRegressor
+
+    Returns a dict with the fitted 'scaler', 'rating' and 'age' models, the test set 'metrics', and the
+    'data_mean' the faces were encoded with (None if the store does not record it)
+    '''
+    # scikit-learn is slow to import, so only imported when training
+    from sklearn.linear_model import SGDRegressor
+    from sklearn.preprocessing import StandardScaler
+
+    store = FeatureStore(store_path)
+    check_groups(groups, store)
+    random = np.random.RandomState(seed)
+    chunk_starts = list(range(0, len(store), chunk_size))
+
+    def train_chunks(order):
+        features, labels = store.features(), store.labels()
+        for start in order:
+            stop = min(start + chunk_size, len(store))
+            train = ~hash_split(split_keys(start, stop, groups), test_size, seed)
+            yield np.asarray(features[start:stop][train], dtype=np.float64), labels[start:stop][train]
+
+    scaler = StandardScaler()
+    for X, _ in train_chunks(chunk_starts):
+        if len(X):
+            scaler.partial_fit(X)
+
+    sgd_params = dict({'penalty': 'l2', 'alpha': 1e-4, 'learning_rate': 'invscaling', 'random_state': seed},
+                      **sgd_params)
+    models = {'rating': SGDRegressor(**sgd_params), 'age': SGDRegressor(**sgd_params)}
+    for epoch in range(epochs):
+        for X, y in train_chunks(random.permutation(chunk_starts)):
+            if not len(X):
+                continue
+            shuffle = random.permutation(len(X))
+            X, y = scaler.transform(X[shuffle]), y[shuffle]
+            models['rating'].partial_fit(X, y[:, 0])
+            models['age'].partial_fit(X, y[:, 1])
+
+    model = dict(models, scaler=scaler, data_mean=store.meta.get('data_mean'))
+    model['metrics'] = evaluate_streaming(model, store_path, chunk_size, test_size, seed, groups)
+    return model
+
+def evaluate_streaming(model, store_path, chunk_size=4096, test_size=0.1, seed=0, groups=None):
+    '''
+    Evaluates ``model`` (as returned by ``train_streaming``) on the test rows of the store at ``store_path``.
+    Returns a dict of the mean absolute error, root mean squared error and R^2 for 'rating' and 'age'
+    '''
+    store = FeatureStore(store_path)
+    check_groups(groups, store)
+    sums = {target: np.zeros(4) for target in ('rating', 'age')} # |error|, error^2, y, y^2
+    count = 0
+    for start, features, labels in store.iter_chunks(chunk_size):
+        test = hash_split(split_keys(start, start + len(features), groups), test_size, seed)
+        if not test.any():
+            continue
+        X = model['scaler'].transform(np.asarray(features[test], dtype=np.float64))
+        count += int(test.sum())
+        for column, target in enumerate(('rating', 'age')):
+            y = labels[test][:, column].astype(np.float64)
+            error = model[target].predict(X) - y
+            sums[target] += [np.abs(error).sum(), (error**2).sum(), y.sum(), (y**2).sum()]
+
+    metrics = {}
+    for target, (abs_error, sq_error, y_sum, y_sq) in sums.items():
+        variance = y_sq / max(count, 1) - (y_sum / max(count, 1))**2
+        metrics[target] = {'mae': float(abs_error / max(count, 1)),
+                           'rmse': float(np.sqrt(sq_error / max(count, 1))),
+                           'r2': float(1 - (sq_error / max(count, 1)) / variance) if variance > 0 else float('nan')}
+    metrics['test_samples'] = count
+    return metrics
+
+def save_model(model, path):
+    '''
+    Pickles ``model`` (as returned by ``train_streaming``) to ``path``
+    '''
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'wb') as f:
+        pickle.dump(model, f)
 
-# reading in the CSV file as an numpy array
-female_data = read_csv(female_csv).values
-X_female, rating_female, age_female = female_data[:, :-2], female_data[:, -2], female_data[:, -1]
+def load_model(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
 
-# perform a train/test split. 90% used for training and 10% for testing
-X_female_train, X_female_test, rating_female_train, rating_female_test = train_test_split(X_female, rating_female,
-                                                                                          test_size=0.1)
+def plot_distributions(store_path, num_samples=1000):
+    '''
+    Plots the rating distribution of the ratings, as well as the age, of the first ``num_samples`` faces
+    '''
+    import matplotlib.pyplot as plt
+    labels = FeatureStore(store_path).labels()[:num_samples]
+    plt.hist(labels[:, 0], bins=10, range=(0,10)); plt.show(); plt.clf()
+    plt.hist(labels[:, 1], bins=80, range=(0,80)); plt.show(); plt.clf()
 
-# first we plot the rating distribution of the ratings, as well as the age
-plt.hist(rating_female_train[:1000], bins=10, range=(0,10)); plt.show(); plt.clf()
-plt.hist(age_female[:1000], bins=80, range=(0,80)); plt.show(); plt.clf()
+if __name__ == '__main__':
+    # first we plot the rating distribution of the ratings, as well as the age
+    plot_distributions(female_store)
 
+    # train on 90%, test on the other 10%, keeping faces posted more than once on one side
+    female_model = train_streaming(female_store, test_size=0.1, groups=load_groups(female_store))
+    print('female test metrics:', female_model['metrics'])
+    save_model(female_model, model_root + 'female.pkl')
@@ -9,57 +9,110 @@ Created on 21 Aug 2017
     then find faces in each image - creating a new database which contains the faces
     alongside its ratings, age and gender
 '''
-# find faces
-import face_recognition
-
 # image processing
 from PIL import Image
-from scipy.misc import toimage 
 
 # web
-import requests
-from io import BytesIO
-import timeout_decorator
+from downloader import ImageDownloader
+from face_pipeline import FacePipeline
+from face_cache import FaceCache
+
+# storage of the faces found
+from to_square_database import SquareWriter
 
 # file management
 import os
 import json
+import itertools
 
 # for debugging / optimizing
-import timeit
 import pprint as pp
+from metrics import METRICS, MetricsExporter, NO_FACE, CORRUPT_IMAGE, ARRAY_ERROR
 
 # general misc. use
 import numpy as np
 
-# shrink the image down to ``MAX_DIM`` faster processing. Chosen as at this size,
-# the face is still visible
+# faces are looked for in a thumbnail of the image shrunk down to ``MAX_DIM`` for
+# faster processing. Chosen as at this size, the face is still visible
 # 400 in general results in faces found to be ~50-150px in dimension
 MAX_DIM = 400
+# faces are then cropped from the image shrunk down to ``SOURCE_DIM`` only, where they
+# are ~150-450px, enough for the 224px squares the encoder takes
+SOURCE_DIM = 3 * MAX_DIM
+
+# face detector, created in each detection process as it is first used
+_detector = None
+
+# downloader used when fetching single links through ``get_face``
+_downloader = None
+
+# where the progress through the link files is saved
+CONFIG_PATH = './config/progress.config'
+config_path = CONFIG_PATH
+
+# where faces are saved, set by ``scrape``
+save_dir = None
+squares = None
 
 def get_face(img_url):
     '''
         Returns images as numpy arrays of the faces found in the image link stored in
         ``img_url``
         
-        Note to save CPU time the image is resized to be smaller
+        Note to save CPU time faces are looked for in a smaller version of the image,
+        though they are cropped from a larger one
+    '''
+    return get_face_from_image(_url_to_image(img_url))
+
+def get_face_from_image(raw_image):
+    '''
+        Returns the largest face found in the already decoded ``raw_image``, or None
+        if there isn't one. ``raw_image`` may be None, for a link that was dead.
+    '''
+    image_arr = _prepare_image(raw_image)
+    if image_arr is None: return None
+    
+    found = _detect_face(image_arr)
+    if found is None: return None
+    
+    found_face, _ = found
+    return Image.fromarray(found_face)
+
+def _prepare_image(raw_image):
+    '''
+        Shrinks the downloaded ``raw_image`` to ``SOURCE_DIM`` and turns it into a numpy
+        array ready for face detection. Returns None if the link was dead or the image is corrupted.
     '''
-    raw_image = _url_to_image(img_url)
     if not raw_image: return None # check link is live
     
-    image = _shrink_image(raw_image)
+    image = _shrink_image(raw_image, SOURCE_DIM)
     if not image: return None # check image is not corrupted
     
-    image_arr = _to_numpy(image)
+    return _to_numpy(image)
+
+def _detect_face(image_arr):
+    '''
+        Finds the largest face in the numpy image ``image_arr``. Returns the face cropped
+        out of ``image_arr`` along with its (top, right, bottom, left) location, or None
+        if no face is found.
+        
+        Faces are looked for in a ``MAX_DIM`` thumbnail first, then confirmed around
+        where they were found at full resolution (see face_detection.py).
+        This is the CPU-heavy step, ran in worker processes by the pipeline.
+    '''
+    global _detector
+    if _detector is None:
+        # imported here as dlib is slow to load, and only needed by the detection processes
+        from face_detection import CoarseToFineDetector
+        _detector = CoarseToFineDetector(coarse_dim=MAX_DIM)
     
-    # face_locations returns the locations of the faces on the image
-    start = timeit.default_timer()
-    try: # some images cause format errors
-        face_locations = face_recognition.face_locations(image_arr)
-    except:
-        face_locations = []
-    end = timeit.default_timer()
-    print('time taken: %.3f' % (end-start))
+    # detect returns the locations of the faces on the image
+    with METRICS.timer('detect'):
+        try: # some images cause format errors
+            face_locations = _detector.detect(image_arr)
+        except:
+            METRICS.failure('detect', CORRUPT_IMAGE)
+            face_locations = []
     
     if face_locations:
         # if faces were found, then
@@ -67,50 +120,47 @@ def get_face(img_url):
         try:
             found_face = image_arr[t:b, l:r, :]
         except: # array error
+            METRICS.failure('detect', ARRAY_ERROR)
             return None
         
         print('face & image size:', found_face.shape, image_arr.shape)
 
-        return toimage(found_face)
+        return found_face, (t, r, b, l)
     else:
         # no faces found
+        METRICS.failure('detect', NO_FACE)
         return None
     
-@timeout_decorator.timeout(10)
 def _url_to_image(url):
     '''
         Reads in the image from the url given. Returns an image object.
         Returns None otherwise
     '''
-    # request.get(url).content returns in bytes, and BytesIO allows it to be read by
-    # Image.open
-    try :
-        print('Reading link:', url)
-        image = Image.open(BytesIO(requests.get(url).content))
-        print('Image read!')
-        return image
-    except: # no image found
-        print('No image found on', url)
-        return None
+    global _downloader
+    if _downloader is None:
+        _downloader = ImageDownloader()
+    print('Reading link:', url)
+    # JPEGs are decoded at reduced scale, no smaller than the image is shrunk to anyway
+    return _downloader.fetch(url, SOURCE_DIM)
     
 def _to_numpy(image):
     '''
         Takes in an ``image`` and turns it into a numpy array.
     '''
-    image_arr = np.asarray(image)
-    image_arr.setflags(write = True) # make image writable for face-recognition
-    return image_arr
+    # copied, as face-recognition needs a writable image, and arrays viewing the image's memory can't be made
+    # writable in current numpy
+    return np.array(image)
 
-def _shrink_image(image):
+def _shrink_image(image, max_dim=MAX_DIM):
     '''
         Takes in an image object and shrinks it, maintaining its aspect ratio. The
         shrink is guaranteed to happen, with the largest dimension capped to
-        ``MAX_DIM``
+        ``max_dim``
         
         Returns the resized image.
     '''
     w, h = image.size
-    shrink_factor = max(w/MAX_DIM, h/MAX_DIM)
+    shrink_factor = max(w/max_dim, h/max_dim)
     if shrink_factor > 1:
         try:
             return image.resize((int(w/shrink_factor), int(h/shrink_factor)))
@@ -133,10 +183,15 @@ def _find_largest_face(face_locations):
     face_sizes = np.array(list(map(size_fn, face_locations)))
     return face_locations[np.argmax(face_sizes)]
 
-def save_post(post):
+def save_post(post, faces=None):
     '''
         Input: a ``post`` (structure [links_list, gender, rating, age])
-        Grabs the links and saves information locally
+        Grabs the links and saves information locally: squared into the shard databases
+        if ``squares`` is set, and as raw .png and .csv files if ``save_dir`` is set
+        
+        ``faces`` are the faces already found in the post's links, in the same order
+        (None where no face was found), as given by ``find_post_faces``. If not given,
+        the links are processed one by one.
     '''
     img_links = post[0]
     gender = post[1]; rating = post[2]; age = post[3]
@@ -145,36 +200,92 @@ def save_post(post):
     if not img_links: # make sure there are links to go through
         print('No links found on this post.')
         return None
-    for im in img_links:
-        face = get_face(im)
+    if faces is None:
+        faces = map(get_face, img_links)
+    for face in faces:
         if face:
             # face is found in the image link
-            save_name = save_dir + str(settings['img_num'])
-            # save the image
-            face.save(save_name + '.png')
-            # save associated information
-            img_info = [settings['img_num'], gender, rating, age]
-            with open(save_name + '.csv', 'w+') as f:
-                json.dump(img_info, f)
+            if squares is not None:
+                squares.add(np.asarray(face.convert('RGB')), gender, rating, age)
+            if save_dir is not None:
+                with METRICS.timer('save'):
+                    save_name = save_dir + str(settings['img_num'])
+                    # save the image
+                    face.save(save_name + '.png')
+                    # save associated information
+                    img_info = [settings['img_num'], gender, rating, age]
+                    with open(save_name + '.csv', 'w+') as f:
+                        json.dump(img_info, f)
             
             settings['img_num'] += 1
 
+def find_post_faces(posts, pipeline):
+    '''
+        Finds the faces in the links of ``posts`` using the FacePipeline ``pipeline``.
+        
+        Yields (post, faces) in the order of ``posts``, where ``faces`` are the faces
+        found in the post's links (None where there were none). Links of later posts
+        go through the pipeline while earlier posts are being saved.
+    '''
+    links = (link for post in posts for link in (post[0] or []))
+    found = pipeline.imap(links)
+    for post in posts:
+        num_links = len(post[0] or [])
+        faces = [None if result is None else Image.fromarray(result[0])
+                 for _, result in itertools.islice(found, num_links)]
+        yield post, faces
+
 def save_data():
     '''
         Saves dictionary ``settings`` to disk
     '''
-    with open('./config/progress.config', 'w+') as f:
+    with open(config_path, 'w+') as f:
         json.dump(settings, f)
+    # faces saved so far are in the cache too, in case the next run goes over them again
+    cache.flush()
+    # the databases are saved along with the progress, so a resumed run neither misses
+    # nor repeats faces
+    if squares is not None:
+        squares.flush()
         
     print('DATA SAVED!')
     print(settings)
+    print('cache:', cache.stats)
+    exporter.write()
 
-if __name__ == '__main__':
-    # reads links from ./data/image_links/ (json files); save the images to ./image/raw
+def scrape(links_root='./data/image_links',
+           config=CONFIG_PATH,
+           square_root='./images/database_square/',
+           raw_dir=None,
+           cache_path='./data/face_cache_multires.sqlite',
+           download_threads=16,
+           max_per_host=8,
+           processes=None,
+           max_pending=128,
+           metrics_path='./logs/save_faces.prom',
+           profile_stages=()):
+    '''
+        Finds the faces in the links of the link files in ``links_root``, carrying on from
+        the progress saved in ``config``.
+        
+        Faces are squared straight into the male and female databases under
+        ``square_root`` (read by encode_faces.py), unless it is None. The raw faces
+        (.png, with a .csv of their features) are only saved if ``raw_dir`` is set, e.g.
+        to './images/raw2/' to square them later with to_square_database.py.
+        
+        download_threads, max_per_host: see ImageDownloader
+        processes, max_pending: see FacePipeline
+        metrics_path: file the metrics of each stage are written to every 30s
+        profile_stages: stages to profile with cProfile (in this process), e.g.
+                        ['download', 'decode']; written to ./logs/profiles/
+    '''
+    global settings, config_path, save_dir, squares, cache, exporter
+    # reads links from ./data/image_links/ (json files)
     # json files are a list of lists, with each element corresponding to a 'post'. Each 
     # post has a few links, and the first element represents the links.
     # to store relational data, the data is indexed by ``filenum``
-    save_dir = './images/raw2/'
+    config_path = config
+    save_dir = raw_dir
     
     # initial settings and database
     settings = {'img_num': 0,
@@ -182,12 +293,24 @@ if __name__ == '__main__':
                 'progress_through_file': 0}
     
     # load the settings and database saved previously
-    with open('./config/progress.config') as f:
+    with open(config_path) as f:
         settings = json.load(f)
         
+    # rates, latencies and failures of each stage, written every 30s
+    exporter = MetricsExporter(METRICS, metrics_path, interval=30)
+    METRICS.enable_profiling(profile_stages)
+    
     # go through the links; save the images to file
+    squares = None
+    if square_root is not None:
+        squares = SquareWriter(os.path.join(square_root, 'male/'), os.path.join(square_root, 'female/'))
+    # faces cached before crops were taken at ``SOURCE_DIM`` are smaller, so kept apart
+    cache = FaceCache(cache_path)
+    downloader = ImageDownloader(max_workers=download_threads, max_per_host=max_per_host)
+    pipeline = FacePipeline(downloader, _prepare_image, _detect_face, processes=processes,
+                            max_pending=max_pending, cache=cache, max_dim=SOURCE_DIM)
     try:            
-        for root, dirs, files in os.walk('./data/image_links'):
+        for root, dirs, files in os.walk(links_root):
             # sort files so we always go through the same order of files
             files.sort()
             
@@ -210,9 +333,11 @@ if __name__ == '__main__':
                     progress = settings['progress_through_file']
                     link_list = link_list[progress:]
                     
-                    for i, post in enumerate(link_list):
+                    # faces come back in order, so ``img_num`` is the same however the
+                    # work is spread over the detection processes
+                    for i, (post, faces) in enumerate(find_post_faces(link_list, pipeline)):
                         print('Processing post {}'.format(i))
-                        save_post(post)
+                        save_post(post, faces)
                         settings['progress_through_file'] += 1
                     
                 # done with the current file - reset progress to 0
@@ -222,4 +347,14 @@ if __name__ == '__main__':
     except Exception as e:
         print('Ran into exception', e)
     finally: # save data if we run into any errors
-        save_data()
\ No newline at end of file
+        pipeline.close()
+        downloader.close()
+        save_data()
+        cache.close()
+        if squares is not None:
+            squares.close()
+        exporter.close()
+        METRICS.dump_profiles('./logs/profiles/')
+
+if __name__ == '__main__':
+    scrape()
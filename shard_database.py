@@ -0,0 +1,289 @@
+'''
+Created on 18 Oct 2026
+
+@author: pingshiyu
+'''
+'''
+Fixed-shape shard format for the square face database. A database is a folder containing
+- index.json: shapes, number of samples, shard size and any extra metadata (e.g. the channel means)
+- <shard>.images: raw uint8 array of shape (n, 224, 224, 3), the faces
+- <shard>.features: raw float32 array of shape (n, 2), the faces' [rating, age]
+
+Every shard except the last holds exactly ``shard_size`` samples, so sample ``i`` lives in shard
+``i // shard_size`` at row ``i % shard_size``. Shards are opened with ``np.memmap`` so reading a sample or a batch
+is a slice into the mapped file, with nothing unpickled or copied.
+'''
+import glob
+import json
+import os
+
+import numpy as np
+
+IMAGE_SHAPE = (224, 224, 3)
+FEATURE_DIM = 2
+
+class ShardWriter():
+    def __init__(self, path, image_shape=IMAGE_SHAPE, feature_dim=FEATURE_DIM, shard_size=1000, overwrite=False):
+        '''
+        Appends samples to the database in folder ``path``. If there is already a database in ``path`` the samples
+        are added after the existing ones (its shapes and shard size are kept), unless ``overwrite`` is set.
+        path: String
+        image_shape: shape of each image, (height, width, channels)
+        feature_dim: number of features stored with each image
+        shard_size: number of samples per shard
+        overwrite: whether to delete an existing database in ``path`` first
+        '''
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        if overwrite:
+            remove_database(path)
+        if os.path.exists(_index_path(path)):
+            self.index = _read_index(path)
+            # anything written after the last index update is an incomplete write, drop it
+            _truncate_last_shard(path, self.index)
+        else:
+            self.index = {'image_shape': list(image_shape),
+                          'feature_dim': feature_dim,
+                          'shard_size': shard_size,
+                          'count': 0,
+                          'meta': {}}
+        self._image_file, self._feature_file = None, None
+
+    def __len__(self):
+        return self.index['count']
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def append(self, image, feature):
+        '''
+        Adds a single sample
+        image: uint8 numpy array of shape ``image_shape``
+        feature: sequence of ``feature_dim`` numbers
+        '''
+        self.append_batch(np.asarray(image)[np.newaxis], np.asarray(feature)[np.newaxis])
+
+    def append_batch(self, images, features):
+        '''
+        Adds a batch of samples
+        images: uint8 numpy array of shape (n, *image_shape)
+        features: numpy array of shape (n, feature_dim)
+        '''
+        images = np.ascontiguousarray(images, dtype=np.uint8)
+        features = np.ascontiguousarray(features, dtype=np.float32)
+        if images.shape[1:] != tuple(self.index['image_shape']):
+            raise ValueError('images of shape {} given, database holds {}'.format(images.shape[1:],
+                                                                                  self.index['image_shape']))
+
+        shard_size = self.index['shard_size']
+        start = 0
+        while start < len(images):
+            # fill up the current shard before starting the next
+            room = shard_size - self.index['count'] % shard_size
+            stop = start + room
+            self._shard_files()
+            self._image_file.write(images[start:stop].tobytes())
+            self._feature_file.write(features[start:stop].tobytes())
+            self.index['count'] += len(images[start:stop])
+            start = stop
+            if self.index['count'] % shard_size == 0:
+                self._close_files()
+
+    def flush(self, **meta):
+        '''
+        Writes buffered samples and the index to disk. Any keyword arguments are stored in the index's metadata.
+        '''
+        self.index['meta'].update(meta)
+        for f in (self._image_file, self._feature_file):
+            if f is not None:
+                f.flush()
+        _write_index(self.path, self.index)
+
+    def close(self, **meta):
+        '''
+        Finishes writing the database. Any keyword arguments are stored in the index's metadata.
+        '''
+        self.flush(**meta)
+        self._close_files()
+
+    def _shard_files(self):
+        '''
+        Opens the files of the shard the next sample goes into, if not already open
+        '''
+        if self._image_file is None:
+            shard = self.index['count'] // self.index['shard_size']
+            self._image_file = open(_shard_path(self.path, shard, 'images'), 'ab')
+            self._feature_file = open(_shard_path(self.path, shard, 'features'), 'ab')
+
+    def _close_files(self):
+        for f in (self._image_file, self._feature_file):
+            if f is not None:
+                f.close()
+        self._image_file, self._feature_file = None, None
+
+class ShardDatabase():
+    def __init__(self, path, mode='r'):
+        '''
+        Opens the database in folder ``path`` for reading. With ``mode='r+'`` samples can be written in place.
+        '''
+        self.path = path
+        self.mode = mode
+        self.index = _read_index(path)
+        self.image_shape = tuple(self.index['image_shape'])
+        self.feature_dim = self.index['feature_dim']
+        self.shard_size = self.index['shard_size']
+        self.meta = self.index['meta']
+        self._shards = {}
+
+    def __len__(self):
+        return self.index['count']
+
+    @property
+    def num_shards(self):
+        return -(-len(self) // self.shard_size)
+
+    def shard(self, n):
+        '''
+        Returns (images, features) of shard ``n`` as memory-mapped arrays
+        '''
+        if n not in self._shards:
+            count = min(self.shard_size, len(self) - n * self.shard_size)
+            if count <= 0:
+                raise IndexError('shard {} out of range'.format(n))
+            images = np.memmap(_shard_path(self.path, n, 'images'), dtype=np.uint8, mode=self.mode,
+                               shape=(count,) + self.image_shape)
+            features = np.memmap(_shard_path(self.path, n, 'features'), dtype=np.float32, mode=self.mode,
+                                 shape=(count, self.feature_dim))
+            self._shards[n] = images, features
+        return self._shards[n]
+
+    def __getitem__(self, i):
+        '''
+        Returns (image, feature) of sample ``i``, as views into the mapped shard
+        '''
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('sample {} out of range'.format(i))
+        images, features = self.shard(i // self.shard_size)
+        return images[i % self.shard_size], features[i % self.shard_size]
+
+    def batch(self, start, stop):
+        '''
+        Returns (images, features) of samples ``start`` to ``stop``. This is a view into the mapped shard if the
+        samples are in the same shard, otherwise the slices of each shard are concatenated.
+        '''
+        stop = min(stop, len(self))
+        first, last = start // self.shard_size, (stop - 1) // self.shard_size
+        if first == last:
+            images, features = self.shard(first)
+            offset = first * self.shard_size
+            return images[start-offset:stop-offset], features[start-offset:stop-offset]
+        parts = [self.batch(max(start, n * self.shard_size), min(stop, (n + 1) * self.shard_size))
+                 for n in range(first, last + 1)]
+        images, features = zip(*parts)
+        return np.concatenate(images), np.concatenate(features)
+
+    def iter_batches(self, batch_size):
+        '''
+        Yields (images, features) batches of up to ``batch_size`` samples, in order. Batches never cross a shard so
+        they are all views into the mapped shards; the last batch of each shard may be smaller.
+        '''
+        for n in range(self.num_shards):
+            images, features = self.shard(n)
+            for i in range(0, len(images), batch_size):
+                yield images[i:i+batch_size], features[i:i+batch_size]
+
+    def flush(self, **meta):
+        '''
+        Writes samples changed in place back to disk. Any keyword arguments are stored in the index's metadata.
+        '''
+        for images, features in self._shards.values():
+            images.flush(); features.flush()
+        if meta:
+            self.meta.update(meta)
+            _write_index(self.path, self.index)
+
+    def close(self):
+        '''
+        Flushes, then drops the mappings of the shards, e.g. before the database is replaced
+        '''
+        self.flush()
+        self._shards = {}
+
+def create_database(path, count, image_shape=IMAGE_SHAPE, feature_dim=FEATURE_DIM, shard_size=1000, overwrite=False):
+    '''
+    Creates a database in folder ``path`` with room for ``count`` samples, all zero. The samples are then filled in
+    with ``ShardDatabase(path, mode='r+')``, which several processes may do at once as long as they write different
+    samples.
+    overwrite: whether to replace a database already in ``path`` which holds samples. Otherwise a FileExistsError is
+               raised, rather than deleting e.g. the faces the scraper has been adding to it.
+    '''
+    check_replaceable(path, overwrite)
+    os.makedirs(path, exist_ok=True)
+    remove_database(path)
+    index = {'image_shape': list(image_shape),
+             'feature_dim': feature_dim,
+             'shard_size': shard_size,
+             'count': count,
+             'meta': {}}
+    image_bytes = int(np.prod(image_shape))
+    for shard in range(-(-count // shard_size)):
+        shard_count = min(shard_size, count - shard * shard_size)
+        # sized with truncate, so the files are sparse until written
+        for kind, row_bytes in (('images', image_bytes), ('features', 4 * feature_dim)):
+            with open(_shard_path(path, shard, kind), 'wb') as f:
+                f.truncate(shard_count * row_bytes)
+    _write_index(path, index)
+
+def check_replaceable(path, overwrite=False):
+    '''
+    Raises a FileExistsError if there is a database holding samples in folder ``path``, unless ``overwrite`` is set
+    '''
+    if overwrite or not os.path.exists(_index_path(path)):
+        return
+    count = _read_index(path)['count']
+    if count > 0:
+        raise FileExistsError('database of {} samples already in {}, set overwrite to replace it'.format(count, path))
+
+def remove_database(path):
+    '''
+    Deletes the index and shards of the database in folder ``path``, if there is one
+    '''
+    for file_path in glob.glob(os.path.join(path, '*.images')) + glob.glob(os.path.join(path, '*.features')):
+        os.remove(file_path)
+    if os.path.exists(_index_path(path)):
+        os.remove(_index_path(path))
+
+def _index_path(path):
+    return os.path.join(path, 'index.json')
+
+def _shard_path(path, shard, kind):
+    return os.path.join(path, '{:05d}.{}'.format(shard, kind))
+
+def _read_index(path):
+    with open(_index_path(path)) as f:
+        return json.load(f)
+
+def _write_index(path, index):
+    # write then rename, so the index on disk is always complete
+    tmp_path = _index_path(path) + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, _index_path(path))
+
+def _truncate_last_shard(path, index):
+    '''
+    Cuts the last shard's files down to the number of samples recorded in ``index``
+    '''
+    count_in_shard = index['count'] % index['shard_size']
+    shard = index['count'] // index['shard_size']
+    image_bytes = int(np.prod(index['image_shape']))
+    for kind, row_bytes in (('images', image_bytes), ('features', 4 * index['feature_dim'])):
+        shard_path = _shard_path(path, shard, kind)
+        if os.path.exists(shard_path):
+            with open(shard_path, 'r+b') as f:
+                f.truncate(count_in_shard * row_bytes)
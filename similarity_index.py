@@ -0,0 +1,216 @@
+'''
+Created on 18 Oct 2026
+
+@author: pingshiyu
+'''
+'''
+Cosine similarity search over the encoded faces of a feature store (see feature_store.py), to find the same face
+posted several times.
+
+Searches read the store in chunks, so memory is bounded by the chunk size rather than the number of faces:
+- exact: every query chunk is multiplied against every chunk of the store, keeping the ``k`` best so far
+- approximate (IVF): the faces are clustered with k-means, and each query is only compared with the faces in the
+  ``nprobe`` clusters nearest to it. The clusters are of the faces less the mean face: fc7 features are all positive
+  so, uncentred, they all crowd round the mean and k-means puts most of them in one cluster.
+
+Faces more similar than a threshold are joined into groups (``duplicate_groups``). The groups are saved with the
+store (groups.npy) and used as the keys of the train/test split in regression_train.py, so all the faces of a group
+end up on the same side of the split.
+'''
+import os
+import logging
+
+import numpy as np
+
+from feature_store import FeatureStore
+
+class SimilarityIndex():
+    def __init__(self, store_path, chunk_size=4096):
+        '''
+        Indexes the features of the store at ``store_path``, reading ``chunk_size`` rows at a time
+        '''
+        self.store = FeatureStore(store_path)
+        self.chunk_size = chunk_size
+        self._features = self.store.features()
+        # rows are normalised as they are read, so only their norms (and the mean, for clustering) are kept
+        norms, total = [], np.zeros(self.store.width)
+        for start in range(0, len(self), chunk_size):
+            rows = np.asarray(self._features[start:start+chunk_size], dtype=np.float32)
+            norms.append(np.linalg.norm(rows, axis=1))
+            total += rows.sum(0)
+        self.norms = np.concatenate(norms or [np.zeros(0)])
+        self.norms[self.norms == 0] = 1
+        self.mean = (total / max(len(self), 1)).astype(np.float32)
+        self.centroids, self.lists = None, None
+
+    def __len__(self):
+        return len(self.store)
+
+    def build_ivf(self, num_lists=None, seed=0):
+        '''
+        Clusters the faces into ``num_lists`` clusters (by default about the square root of the number of faces) for
+        approximate search, fitting k-means a chunk at a time
+        '''
+        from sklearn.cluster import MiniBatchKMeans # only needed for approximate search
+        num_lists = num_lists or max(1, int(np.sqrt(len(self))))
+        kmeans = MiniBatchKMeans(num_lists, random_state=seed, batch_size=self.chunk_size, n_init=1)
+        # the first chunk must have at least one row per cluster
+        first = max(self.chunk_size, num_lists)
+        kmeans.partial_fit(self._centred(np.arange(min(first, len(self)))))
+        for start in range(first, len(self), self.chunk_size):
+            kmeans.partial_fit(self._centred(np.arange(start, min(start + self.chunk_size, len(self)))))
+
+        self.centroids = _normalise(kmeans.cluster_centers_.astype(np.float32))
+        assignments = np.concatenate([np.argmax(np.dot(self._centred(ids), self.centroids.T), axis=1)
+                                      for ids in self._chunks(np.arange(len(self)))])
+        self.lists = [np.flatnonzero(assignments == c) for c in range(num_lists)]
+        logging.info('clustered {} faces into {} lists of at most {}'.format(
+            len(self), num_lists, max(len(ids) for ids in self.lists)))
+
+    def knn(self, queries=None, k=10, approximate=False, nprobe=8):
+        '''
+        Finds the ``k`` faces most similar to each of the faces at indices ``queries`` (all of them by default),
+        leaving out the query itself.
+        approximate: whether to search only the ``nprobe`` nearest clusters (see ``build_ivf``, which is called if
+                     the index has no clusters yet)
+
+        Returns (indices, similarities), arrays of shape (number of queries, k) sorted most similar first. Where
+        fewer than ``k`` faces were compared, the rest are -1 with similarity -inf.
+        '''
+        queries = np.arange(len(self)) if queries is None else np.asarray(queries)
+        if approximate and self.centroids is None:
+            self.build_ivf()
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+        similarities = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        done = 0
+        for query_ids in self._chunks(queries):
+            rows = slice(done, done + len(query_ids))
+            search = self._search_ivf if approximate else self._search_exact
+            indices[rows], similarities[rows] = search(query_ids, k, nprobe)
+            done += len(query_ids)
+            logging.info('searched {} of {} faces'.format(done, len(queries)))
+        indices[np.isneginf(similarities)] = -1
+        return indices, similarities
+
+    def _search_exact(self, query_ids, k, nprobe):
+        Q = self._rows(query_ids)
+        best_ids = np.full((len(Q), k), -1, dtype=np.int64)
+        best = np.full((len(Q), k), -np.inf, dtype=np.float32)
+        for ids in self._chunks(np.arange(len(self))):
+            similarities = np.dot(Q, self._rows(ids).T)
+            similarities[query_ids[:, None] == ids[None, :]] = -np.inf
+            best_ids, best = _merge_best(best_ids, best, ids, similarities, k)
+        return best_ids, best
+
+    def _search_ivf(self, query_ids, k, nprobe):
+        Q = self._rows(query_ids)
+        best_ids = np.full((len(Q), k), -1, dtype=np.int64)
+        best = np.full((len(Q), k), -np.inf, dtype=np.float32)
+        nprobe = min(nprobe, len(self.lists))
+        probes = np.argpartition(-np.dot(self._centred(query_ids), self.centroids.T), nprobe - 1, axis=1)[:, :nprobe]
+        # each list is read once, and compared with the queries probing it
+        for c, ids in enumerate(self.lists):
+            probing = np.flatnonzero((probes == c).any(axis=1))
+            if not len(probing) or not len(ids):
+                continue
+            for chunk_ids in self._chunks(ids):
+                similarities = np.dot(Q[probing], self._rows(chunk_ids).T)
+                similarities[query_ids[probing, None] == chunk_ids[None, :]] = -np.inf
+                best_ids[probing], best[probing] = _merge_best(best_ids[probing], best[probing], chunk_ids,
+                                                               similarities, k)
+        return best_ids, best
+
+    def _rows(self, ids):
+        '''
+        Reads the faces at indices ``ids``, normalised
+        '''
+        if len(ids) and ids[-1] - ids[0] + 1 == len(ids):
+            rows = self._features[ids[0]:ids[-1]+1] # contiguous, read as a slice
+        else:
+            rows = self._features[ids]
+        return np.asarray(rows, dtype=np.float32) / self.norms[ids, None]
+
+    def _centred(self, ids):
+        '''
+        Reads the faces at indices ``ids`` less the mean face, normalised, as they are clustered
+        '''
+        return _normalise(self._rows(ids) * self.norms[ids, None] - self.mean)
+
+    def _chunks(self, ids):
+        for start in range(0, len(ids), self.chunk_size):
+            yield ids[start:start+self.chunk_size]
+
+def duplicate_groups(index, threshold=0.9, k=10, approximate=False, nprobe=8):
+    '''
+    Groups together the faces of ``index`` (a SimilarityIndex) whose similarity to another face of the group is
+    above ``threshold``, looking at each face's ``k`` nearest faces.
+
+    Returns an array giving the group of each face, numbered by the group's first face
+    '''
+    neighbours, similarities = index.knn(k=k, approximate=approximate, nprobe=nprobe)
+    faces, columns = np.nonzero(similarities >= threshold)
+    return _union_find(len(index), faces, neighbours[faces, columns])
+
+def save_groups(store_path, groups):
+    np.save(os.path.join(store_path, 'groups.npy'), groups)
+
+def load_groups(store_path):
+    '''
+    Loads the groups saved with the store at ``store_path``, or returns None if there are none, or if they are out
+    of date: rows have been added to the store since (the groups are deleted when the store is rewritten)
+    '''
+    path = os.path.join(store_path, 'groups.npy')
+    if not os.path.exists(path):
+        return None
+    groups = np.load(path)
+    count = len(FeatureStore(store_path))
+    if len(groups) != count:
+        logging.warning('ignoring the groups of {}, saved for {} faces but the store has {}'.format(
+            store_path, len(groups), count))
+        return None
+    return groups
+
+def _union_find(count, a, b):
+    '''
+    Joins ``a[i]`` and ``b[i]`` into the same group for every ``i``. Returns the group of each of ``count`` items,
+    being the smallest item in the group
+    '''
+    parent = np.arange(count)
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]] # path halving
+            x = parent[x]
+        return x
+    for x, y in zip(a, b):
+        x, y = find(x), find(y)
+        if x != y:
+            parent[max(x, y)] = min(x, y)
+    return np.array([find(x) for x in range(count)])
+
+def _merge_best(best_ids, best, ids, similarities, k):
+    '''
+    Merges the similarities of the queries to faces ``ids`` into the ``k`` best so far, keeping them sorted
+    '''
+    all_ids = np.concatenate([best_ids, np.broadcast_to(ids, similarities.shape)], axis=1)
+    all_similarities = np.concatenate([best, similarities], axis=1)
+    top = np.argpartition(-all_similarities, min(k, all_similarities.shape[1]) - 1, axis=1)[:, :k]
+    top_similarities = np.take_along_axis(all_similarities, top, axis=1)
+    order = np.argsort(-top_similarities, axis=1, kind='stable')
+    return (np.take_along_axis(np.take_along_axis(all_ids, top, axis=1), order, axis=1),
+            np.take_along_axis(top_similarities, order, axis=1))
+
+def _normalise(rows):
+    norms = np.linalg.norm(rows, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return rows / norms
+
+if __name__ == '__main__':
+    logging.basicConfig(level = logging.INFO,
+                        format = '%(asctime)s %(message)s')
+
+    data_root = './data/vgg_encoded/'
+    for gender in ('female', 'male'):
+        index = SimilarityIndex(data_root + gender + '/')
+        groups = duplicate_groups(index, threshold=0.9, approximate=len(index) > 20000)
+        save_groups(data_root + gender + '/', groups)
+        print('{}: {} faces in {} groups'.format(gender, len(groups), len(np.unique(groups))))
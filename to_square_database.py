@@ -10,102 +10,240 @@ Save into a new folder of structure
     - male 
     - female
     
-In minibatches, where each minibatch is a pickled file of a list of tuples, in form [image, feature]
+In shards (see shard_database.py), where each shard is a contiguous array of images and an array of their features.
 Where each image has dimension 224x224x3, its features are [rating, age]. Its contents are [7.2, 19] for a 7.2 rated 
 19 year old's face.
+
+The scraper can also square faces into the databases as it finds them (``SquareWriter``), without saving the raw
+faces first.
 '''
 # data reading / writing
 import os, glob
-import json, pickle
+import json
 import logging
-
-# create logger
-logging.basicConfig(filename = './logs/to_square_database.log',
-                    level = logging.DEBUG,
-                    filemode = 'w+',
-                    format = '%(asctime)s %(message)s')
+from multiprocessing import Pool
 
 # processing
 import numpy as np
+from PIL import Image
 from image_processing import resize_to_square, average_intensity
-from scipy.misc import imread
+from shard_database import ShardDatabase, ShardWriter, check_replaceable, create_database
+from metrics import METRICS, MetricsExporter, CORRUPT_IMAGE, reset_worker_metrics
 
 # specify folders to save in
 root = './images/database_square/'
 male_folder = root + 'male/'
 female_folder = root + 'female/'
 
-# keeping track of the male and female datasets
-male_num, female_num = 0, 0
-male_total_pixelvals, female_total_pixelvals = np.array([0.0,0.0,0.0]), np.array([0.0,0.0,0.0])
-male_minibatch, female_minibatch = [], []
-male_batchnum, female_batchnum = 0, 0
-
-for file in glob.glob('./images/raw/*.png'):
-    file_name, ext = os.path.splitext(file)
-    # reads in the image and the features
-    logging.info(('reading file:', file_name))
-    image = imread(file);
-    with open(file_name + '.csv') as f:
-        features = json.load(f)
+# number of files handed to a worker at a time. Fixed, so the result does not depend on the number of workers
+CHUNK_SIZE = 256
+
+def build_square_database(raw_glob='./images/raw/*.png', male_path=male_folder, female_path=female_folder,
+                          workers=None, dim=224, shard_size=1000, overwrite=False):
+    '''
+    Squares the faces matching ``raw_glob`` (each with a .csv JSON sidecar of [index, gender, rating, age]) into a
+    male and a female shard database.
+    
+    The files are processed in sorted order in two passes, both shared out between ``workers`` processes (all
+    cores by default, or ``workers=1`` to work in this process): the sidecars are read and the images checked
+    first to find each face's place in its database, then the images are squared and written straight into those
+    places. The databases are the same whatever the number of workers.
+    
+    Faces without a sidecar, or whose image is corrupted, are left out. An image which can't be read in the second
+    pass (e.g. changed since the first) raises an OSError, as its place has already been given out.
+    
+    The databases are built from scratch. If either path already holds a database with faces in it (such as the
+    scraper's) a FileExistsError is raised before anything is done, unless ``overwrite`` is set to replace them.
+    
+    Returns the male and female average pixel values, which are also stored in the databases' metadata.
+    '''
+    for path in (male_path, female_path):
+        check_replaceable(path, overwrite)
+    files = sorted(glob.glob(raw_glob))
+    chunks = [files[i:i+CHUNK_SIZE] for i in range(0, len(files), CHUNK_SIZE)]
+    pool = Pool(workers, reset_worker_metrics) if workers != 1 else None
+    mapper = pool.imap if pool is not None else map
+    try:
+        # first pass: the features of each file, giving its position in the male or female database
+        labels = []
+        for chunk_labels, chunk_metrics in mapper(_read_labels, chunks):
+            METRICS.merge(chunk_metrics)
+            labels += chunk_labels
+        counts = {'M': 0, 'F': 0}
+        tasks = []
+        for file, label in zip(files, labels):
+            if label is None:
+                continue
+            gender, feature = label
+            tasks.append((file, gender, counts[gender], feature))
+            counts[gender] += 1
+        logging.info('found {} male and {} female faces'.format(counts['M'], counts['F']))
+        
+        create_database(male_path, counts['M'], image_shape=(dim, dim, 3), shard_size=shard_size, overwrite=overwrite)
+        create_database(female_path, counts['F'], image_shape=(dim, dim, 3), shard_size=shard_size,
+                        overwrite=overwrite)
+        
+        # second pass: square the images into their positions. Chunks are reduced in order so the sums
+        # are added up the same way each time
+        task_chunks = [(male_path, female_path, dim, tasks[i:i+CHUNK_SIZE])
+                       for i in range(0, len(tasks), CHUNK_SIZE)]
+        totals = {'M': np.zeros(3), 'F': np.zeros(3)}
+        for chunk_totals, chunk_metrics in mapper(_square_chunk, task_chunks):
+            METRICS.merge(chunk_metrics)
+            for gender in totals:
+                totals[gender] += chunk_totals[gender]
+    finally:
+        if pool is not None:
+            pool.close(); pool.join()
+    
+    # calculate the average pixel intensity
+    male_avg_pixelvals = totals['M'] / max(counts['M'], 1)
+    female_avg_pixelvals = totals['F'] / max(counts['F'], 1)
+    logging.info(('male average pixel values', male_avg_pixelvals))
+    logging.info(('female average pixel values', female_avg_pixelvals))
+    
+    # keep the averages alongside for the encoder
+    ShardDatabase(male_path).flush(mean=male_avg_pixelvals.tolist())
+    ShardDatabase(female_path).flush(mean=female_avg_pixelvals.tolist())
+    return male_avg_pixelvals, female_avg_pixelvals
+
+class SquareWriter():
+    def __init__(self, male_path=male_folder, female_path=female_folder, dim=224, shard_size=1000):
+        '''
+        Squares faces and appends them to the male or female database as they come, keeping running totals for
+        the databases' average pixel values. Databases already in ``male_path`` and ``female_path`` are added to,
+        carrying on from their stored averages.
+        '''
+        self.dim = dim
+        self.writers = {'M': ShardWriter(male_path, image_shape=(dim, dim, 3), shard_size=shard_size),
+                        'F': ShardWriter(female_path, image_shape=(dim, dim, 3), shard_size=shard_size)}
+        # sum of the faces' average pixel values, by gender
+        self.totals = {gender: np.asarray(writer.index['meta'].get('mean', np.zeros(3))) * len(writer)
+                       for gender, writer in self.writers.items()}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, face, gender, rating, age):
+        '''
+        Squares ``face`` (a numpy image) and appends it with its features to the database for ``gender``.
+        Returns whether the face was added, i.e. whether ``gender`` is male or female.
+        '''
+        if gender not in self.writers:
+            logging.warning(('neither male nor female found', gender))
+            return False
+        with METRICS.timer('square'):
+            square = resize_to_square(face, dim=self.dim)
+        with METRICS.timer('write'):
+            self.writers[gender].append(square, [rating, int(age)])
+        self.totals[gender] = self.totals[gender] + average_intensity(face)
+        return True
+
+    def means(self):
+        '''
+        Returns the male and female average pixel values so far
+        '''
+        return tuple(self.totals[gender] / max(len(self.writers[gender]), 1) for gender in ('M', 'F'))
+
+    def flush(self):
+        '''
+        Writes the faces added so far and the average pixel values to disk
+        '''
+        for gender, mean in zip(('M', 'F'), self.means()):
+            self.writers[gender].flush(mean=mean.tolist())
+
+    def close(self):
+        self.flush()
+        for writer in self.writers.values():
+            writer.close()
+
+def _read_labels(files):
+    '''
+    Reads the JSON sidecars of the image ``files``, and checks the images can be read.
+    Returns a list with a (gender, [rating, age]) tuple for each file, or None if the file can't be used, and the
+    metrics of the chunk
+    '''
+    labels = []
+    for file in files:
+        file_name, ext = os.path.splitext(file)
+        try:
+            with open(file_name + '.csv') as f:
+                features = json.load(f)
+        except (OSError, ValueError):
+            features = None
+        
+        if not features:
+            logging.warning(('reading failure - no .csv file found for:', file_name))
+            labels.append(None)
+            continue
         
-    # if both loads then proceed with analysis
-    if features:
-        logging.info(('successfully read:', file_name))
         _, gender, rating, age = features
+        if gender not in ('M', 'F'):
+            logging.warning(('neither male nor female found', file_name))
+            labels.append(None)
+            continue
         age = int(age) # age saved as string, we convert it first
         
-        # form the database entry
-        feature = [rating, age]
-        square_im = resize_to_square(image, dim=224)
-        database_entry = (square_im, feature)
-        
-        # for calculating the average pixel value
-        avg_pixelval = average_intensity(image)
-        if gender == 'M':
-            logging.info(('male found', male_num))
-            male_total_pixelvals += avg_pixelval
-            male_minibatch.append(database_entry); male_num += 1
+        # checked here, before the face is given a place in the database, so there are no blank faces
+        try:
+            with METRICS.timer('verify'):
+                with Image.open(file) as image:
+                    image.verify()
+        except (OSError, SyntaxError):
+            logging.warning(('corrupted image:', file))
+            METRICS.failure('verify', CORRUPT_IMAGE)
+            labels.append(None)
+            continue
+        labels.append((gender, [rating, age]))
+    return labels, METRICS.take()
+
+def _square_chunk(task_chunk):
+    '''
+    Squares a chunk of images and writes each into its place in the male or female database.
+    ``task_chunk`` is (male_path, female_path, dim, tasks) where tasks are (file, gender, position, feature).
+    
+    Returns the sum of the images' average pixel values by gender, and the metrics of the chunk
+    '''
+    male_path, female_path, dim, tasks = task_chunk
+    totals = {'M': np.zeros(3), 'F': np.zeros(3)}
+    # opened for this chunk only: the next build replaces the shard files, and mappings kept from this one would
+    # write into the deleted files
+    databases = {}
+    try:
+        for file, gender, position, feature in tasks:
+            path = male_path if gender == 'M' else female_path
+            if path not in databases:
+                databases[path] = ShardDatabase(path, mode='r+')
+            database = databases[path]
             
-            # save the minibatch once we have 100 entries
-            if (male_num > 0) and (male_num%100 == 0):
-                with open(male_folder + str(male_batchnum), 'wb') as f:
-                    pickle.dump(male_minibatch, f)
-                    logging.info('male minibatch number {} saved!'.format(male_batchnum))
-                    male_minibatch = []; male_batchnum += 1
-                    
-        elif gender == 'F':
-            logging.info(('female found', female_num))
-            female_total_pixelvals += avg_pixelval
-            female_minibatch.append(database_entry); female_num += 1
+            logging.info(('reading file:', file))
+            with METRICS.timer('decode'):
+                image = np.asarray(Image.open(file).convert('RGB'))
             
-            # save the minibatch once we have 100 entries
-            if (female_num > 0) and (female_num%100 == 0):
-                with open(female_folder + str(female_batchnum), 'wb') as f:
-                    pickle.dump(female_minibatch, f)
-                    logging.info('female minibatch number {} saved!'.format(female_batchnum))
-                    female_minibatch = []; female_batchnum += 1
-        else:
-            logging.warning(('neither male nor female found'))
-            logging.warning((file_name, 'male num', male_num, 'female num', female_num))
-    else:
-        logging.warning(('reading failure - no .csv file found for:', file_name))
+            square_im, saved_feature = database[position]
+            with METRICS.timer('square'):
+                square_im[...] = resize_to_square(image, dim=dim)
+            saved_feature[...] = feature
             
-# Save remainder of the minibatch
-with open(male_folder + str(male_batchnum), 'wb') as f:
-    pickle.dump(male_minibatch, f)
-    logging.info('male minibatch number {} saved!'.format(male_batchnum))
-    male_minibatch = []; male_batchnum += 1
-with open(female_folder + str(female_batchnum), 'wb') as f:
-    pickle.dump(female_minibatch, f)
-    logging.info('female minibatch number {} saved!'.format(female_batchnum))
-    female_minibatch = []; female_batchnum += 1
+            # for calculating the average pixel value
+            totals[gender] += average_intensity(image)
+    finally:
+        for database in databases.values():
+            database.close()
+    return totals, METRICS.take()
+
+if __name__ == '__main__':
+    # create logger
+    logging.basicConfig(filename = './logs/to_square_database.log',
+                        level = logging.DEBUG,
+                        filemode = 'w+',
+                        format = '%(asctime)s %(message)s')
     
-# calculate the average pixel intensity
-male_avg_pixelvals = male_total_pixelvals / male_num
-female_avg_pixelvals = female_total_pixelvals / female_num
-logging.info(('male average pixel values', male_avg_pixelvals))
-logging.info(('female average pixel values', female_avg_pixelvals))
+    with MetricsExporter(METRICS, './logs/to_square_database.prom', interval=30):
+        build_square_database('./images/raw/*.png')
 
 '''
 Male average: [149, 112, 98] ~36,400 samples
@@ -0,0 +1,217 @@
+'''
+Created on 18 Oct 2026
+
+@author: pingshiyu
+'''
+'''
+Inference backends for VGG_Encoder. Each backend loads a caffe network definition (.prototxt) and its weights
+(.caffemodel) and runs the forward pass on the CPU:
+- 'caffe': caffe.Net, the reference implementation
+- 'opencv': OpenCV's DNN module, usually much faster on the CPU and installable with pip (opencv-python).
+  Needs OpenCV 4, as the caffe importer was removed in OpenCV 5.
+
+A backend provides
+- input_buffer(shape): a float32 array of ``shape`` (batch, channels, height, width) to write the next input into
+- forward(output_layer, data=None): runs the network on ``data``, or the input buffer if not given, returning the
+  activations of ``output_layer`` as an array of shape (batch, features)
+
+``check_parity`` compares the encodings the backends give, and ``write_tiny_network`` makes a small randomly
+initialised network to run it on, without the full VGG weights.
+'''
+import re
+
+import numpy as np
+
+class CaffeBackend():
+    def __init__(self, model_path, weights_path, threads=None):
+        import caffe
+        self.net = caffe.Net(model_path, weights_path, caffe.TEST)
+        self._input_shape = None
+
+    def input_buffer(self, shape):
+        # reshape only when the shape changes, as reshaping reallocates the blobs
+        if tuple(shape) != self._input_shape:
+            self.net.blobs['data'].reshape(*shape)
+            self._input_shape = tuple(shape)
+        return self.net.blobs['data'].data
+
+    def forward(self, output_layer, data=None):
+        if data is not None:
+            self.input_buffer(data.shape)[...] = data
+        self.net.forward()
+        # copied, as the blob is overwritten by the next batch
+        return self.net.blobs[output_layer].data.reshape(self._input_shape[0], -1).copy()
+
+class OpenCVBackend():
+    def __init__(self, model_path, weights_path, threads=None):
+        import cv2
+        if threads is not None:
+            cv2.setNumThreads(threads)
+        self.net = cv2.dnn.readNetFromCaffe(model_path, weights_path)
+        self.net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+        self.net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+        self._layer_tops = _layer_tops(model_path)
+        self._buffer = None
+
+    def input_buffer(self, shape):
+        if self._buffer is None or self._buffer.shape != tuple(shape):
+            self._buffer = np.empty(shape, dtype=np.float32)
+        return self._buffer
+
+    def forward(self, output_layer, data=None):
+        self.net.setInput(self._buffer if data is None else np.ascontiguousarray(data, dtype=np.float32))
+        # in caffe a blob holds the output of the last layer writing to it (e.g. fc7 after relu7 is applied in
+        # place), so ask OpenCV for that layer's output
+        output = self.net.forward(self._output_layer_name(output_layer))
+        return output.reshape(output.shape[0], -1)
+
+    def _output_layer_name(self, blob):
+        # dropout does nothing at test time, and OpenCV may drop the layer altogether
+        writers = [name for name, layer_type, tops in self._layer_tops
+                   if blob in tops and layer_type.lower() != 'dropout']
+        return writers[-1] if writers else blob
+
+BACKENDS = {'caffe': CaffeBackend,
+            'opencv': OpenCVBackend}
+
+def make_backend(name, model_path, weights_path, threads=None):
+    '''
+    Returns the backend called ``name`` (see ``BACKENDS``) loaded with the network at ``model_path`` and
+    ``weights_path``. ``threads`` is the number of threads the backend may use, if it can be set.
+    '''
+    if name not in BACKENDS:
+        raise ValueError('unknown backend {}, choose from {}'.format(name, sorted(BACKENDS)))
+    return BACKENDS[name](model_path, weights_path, threads=threads)
+
+def _layer_tops(model_path):
+    '''
+    Reads the layers of a .prototxt, returning a list of (name, type, [tops]) in the order they appear
+    '''
+    with open(model_path) as f:
+        prototxt = f.read()
+    layers = []
+    # each layer is a ``layer { ... }`` (or old style ``layers { ... }``) block, whose parameters are nested blocks
+    for block in re.finditer(r'\blayers?\s*\{', prototxt):
+        depth, i = 1, block.end()
+        while depth and i < len(prototxt):
+            depth += {'{': 1, '}': -1}.get(prototxt[i], 0)
+            i += 1
+        body = prototxt[block.end():i-1]
+        # only the layer's own fields, not those of its nested parameter blocks
+        top_level = re.sub(r'\{[^{}]*\}', '', body)
+        while re.search(r'\{[^{}]*\}', top_level):
+            top_level = re.sub(r'\{[^{}]*\}', '', top_level)
+        name = re.search(r'\bname:\s*"([^"]*)"', top_level)
+        layer_type = re.search(r'\btype:\s*"?(\w+)"?', top_level)
+        tops = re.findall(r'\btop:\s*"([^"]*)"', top_level)
+        layers.append((name.group(1) if name else '', layer_type.group(1) if layer_type else '', tops))
+    return layers
+
+def check_parity(model_path, weights_path, data_mean, backends=('caffe', 'opencv'), batch_size=4,
+                 output_layer='fc7', seed=0):
+    '''
+    Encodes the same random batch of images with each of ``backends`` and compares the encodings with those of the
+    first backend.
+
+    Returns a dict of backend name to (max absolute difference, max difference relative to the largest activation)
+    '''
+    from vgg_encoder import VGG_Encoder
+    encoders = [VGG_Encoder(data_mean, model_path, weights_path, output_layer, backend=name) for name in backends]
+    height, width = _input_size(model_path)
+    images = np.random.RandomState(seed).randint(0, 256, (batch_size, height, width, 3)).astype(np.uint8)
+
+    reference = encoders[0].encode_batch(images)
+    scale = max(np.abs(reference).max(), 1e-12)
+    parity = {}
+    for name, encoder in zip(backends[1:], encoders[1:]):
+        difference = np.abs(encoder.encode_batch(images) - reference).max()
+        parity[name] = (difference, difference / scale)
+    return parity
+
+def _input_size(model_path):
+    '''
+    Reads the (height, width) of the network's input from its .prototxt
+    '''
+    with open(model_path) as f:
+        prototxt = f.read()
+    dims = re.findall(r'\b(?:input_)?dim:\s*(\d+)', prototxt)
+    return int(dims[2]), int(dims[3])
+
+# a network with the same layer names as VGG's classifier, small enough to run in milliseconds
+_TINY_NETWORK = '''name: "tiny_vgg"
+input: "data"
+input_dim: 1
+input_dim: 3
+input_dim: {size}
+input_dim: {size}
+layer {{ name: "conv1_1" type: "Convolution" bottom: "data" top: "conv1_1"
+        convolution_param {{ num_output: {channels} kernel_size: 3 pad: 1 }} }}
+layer {{ name: "relu1_1" type: "ReLU" bottom: "conv1_1" top: "conv1_1" }}
+layer {{ name: "pool1" type: "Pooling" bottom: "conv1_1" top: "pool1"
+        pooling_param {{ pool: MAX kernel_size: 2 stride: 2 }} }}
+layer {{ name: "fc6" type: "InnerProduct" bottom: "pool1" top: "fc6" inner_product_param {{ num_output: {features} }} }}
+layer {{ name: "relu6" type: "ReLU" bottom: "fc6" top: "fc6" }}
+layer {{ name: "drop6" type: "Dropout" bottom: "fc6" top: "fc6" dropout_param {{ dropout_ratio: 0.5 }} }}
+layer {{ name: "fc7" type: "InnerProduct" bottom: "fc6" top: "fc7" inner_product_param {{ num_output: {features} }} }}
+layer {{ name: "relu7" type: "ReLU" bottom: "fc7" top: "fc7" }}
+layer {{ name: "drop7" type: "Dropout" bottom: "fc7" top: "fc7" dropout_param {{ dropout_ratio: 0.5 }} }}
+'''
+
+def write_tiny_network(model_path, weights_path, size=32, features=64, channels=8, seed=0):
+    '''
+    Writes a small network shaped like VGG's end (conv, pool, fc6, fc7 with ReLU and dropout) taking ``size``x``size``
+    images and giving ``features`` features, with random weights, to ``model_path`` (.prototxt) and ``weights_path``
+    (.caffemodel). The .caffemodel is written directly, so caffe is not needed.
+    '''
+    with open(model_path, 'w') as f:
+        f.write(_TINY_NETWORK.format(size=size, features=features, channels=channels))
+
+    # weights scaled so activations stay in a sensible range for inputs in [-255*255, 255*255]
+    random = np.random.RandomState(seed)
+    pooled = channels * (size // 2) ** 2
+    layers = [('conv1_1', 'Convolution', [random.randn(channels, 3, 3, 3) / (27 * 255**2), random.randn(channels)]),
+              ('fc6', 'InnerProduct', [random.randn(features, pooled) / pooled**0.5, random.randn(features)]),
+              ('fc7', 'InnerProduct', [random.randn(features, features) / features**0.5, random.randn(features)])]
+    with open(weights_path, 'wb') as f:
+        f.write(_net_parameter('tiny_vgg', layers))
+
+# field numbers of caffe.proto's NetParameter, LayerParameter, BlobProto and BlobShape messages used below
+_NET_NAME, _NET_LAYER = 1, 100
+_LAYER_NAME, _LAYER_TYPE, _LAYER_BLOBS = 1, 2, 7
+_BLOB_DATA, _BLOB_SHAPE = 5, 7
+_SHAPE_DIM = 1
+
+def _net_parameter(name, layers):
+    '''
+    Serialises a caffe NetParameter protobuf holding the weights of ``layers``, a list of (name, type, [arrays])
+    '''
+    def varint(n):
+        out = bytearray()
+        while n > 0x7f:
+            out.append(n & 0x7f | 0x80); n >>= 7
+        out.append(n)
+        return bytes(out)
+
+    def field(number, payload):
+        # all the fields used are length delimited (wire type 2): strings, messages and packed arrays
+        return varint(number << 3 | 2) + varint(len(payload)) + payload
+
+    def blob(array):
+        shape = field(_SHAPE_DIM, b''.join(varint(dim) for dim in array.shape))
+        return field(_BLOB_SHAPE, shape) + field(_BLOB_DATA, array.astype('<f4').tobytes())
+
+    net = field(_NET_NAME, name.encode())
+    for layer_name, layer_type, arrays in layers:
+        layer = field(_LAYER_NAME, layer_name.encode()) + field(_LAYER_TYPE, layer_type.encode())
+        layer += b''.join(field(_LAYER_BLOBS, blob(array)) for array in arrays)
+        net += field(_NET_LAYER, layer)
+    return net
+
+if __name__ == '__main__':
+    # parity of the backends on a tiny random network
+    import os, tempfile
+    folder = tempfile.mkdtemp()
+    model_path, weights_path = os.path.join(folder, 'tiny.prototxt'), os.path.join(folder, 'tiny.caffemodel')
+    write_tiny_network(model_path, weights_path)
+    for name, (absolute, relative) in check_parity(model_path, weights_path, np.array([129, 105, 94])).items():
+        print('{}: max difference from caffe {:.3g} ({:.3g} relative)'.format(name, absolute, relative))
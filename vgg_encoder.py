@@ -9,28 +9,50 @@ The class will make use of the VGG face encoder to encode image batches.
 The method ``encode_batch()`` will take in a batch of images of the standard form, 
 i.e. [imgnum, height, width, channels],
 and will output the corresponding encoded feature array. (dimension [imgnum, 4096])
+
+The network is ran by one of the backends in vgg_backends.py, caffe by default.
 '''
-import caffe
+import numpy as np
+from embedding_cache import encoder_fingerprint
+from vgg_backends import make_backend
+
+# bump when the preprocessing changes, so cached encodings are invalidated
+PREPROCESS_VERSION = '1'
+
+MODEL_PATH = './vgg_face_caffe/VGG_FACE_deploy.prototxt'
+WEIGHTS_PATH = './vgg_face_caffe/VGG_FACE.caffemodel'
 
 class VGG_Encoder():
     def __init__(self,
                  data_mean,
-                 model_path='./vgg_face_caffe/VGG_FACE_deploy.prototxt',
-                 weights_path='./vgg_face_caffe/VGG_FACE.caffemodel'):
+                 model_path=MODEL_PATH,
+                 weights_path=WEIGHTS_PATH,
+                 output_layer='fc7',
+                 backend='caffe',
+                 threads=None):
         '''
         As the network only takes in normalised data we may supply a ``data_mean`` so that we don't have to
         calculate the mean each time. (data_mean: np array)
         If the data is already normalised then simply put np.array([0,0,0]_, for example, for an RGB image, or 
         np.array([0]) for a greyscale image.
+        The encoding is the activation of ``output_layer``, by default the penultimate layer fc7.
+        ``backend`` is the library running the network, see vgg_backends.py. ``threads`` is the number of threads it
+        may use, if it can be set.
         '''
-        self.net = caffe.Net(model_path, weights_path, caffe.TEST)
+        self.model_path, self.weights_path = model_path, weights_path
+        self.data_mean = data_mean
+        self.output_layer = output_layer
+        self.backend_name = backend
+        self.backend = make_backend(backend, model_path, weights_path, threads=threads)
         
-        # create transformer for the input called 'data'
-        self.transformer = caffe.io.Transformer(inputs={'data': self.net.blobs['data'].data.shape})
-        self.transformer.set_transpose('data', (2,0,1))  # move image channels to outermost dimension
-        self.transformer.set_mean('data', data_mean)     # subtract the dataset-mean value in each channel
-        self.transformer.set_raw_scale('data', 255)      # rescale from [0, 1] to [0, 255]
-        self.transformer.set_channel_swap('data', (2,1,0))  # swap channels from RGB to BGR
+        # preprocessing for the input called 'data', the same as caffe.io.Transformer with:
+        # - transpose (2,0,1): move image channels to outermost dimension
+        # - channel swap (2,1,0): swap channels from RGB to BGR
+        # - raw scale 255: rescale from [0, 1] to [0, 255]
+        # - mean: subtract the dataset-mean value in each channel
+        # but done on the whole batch at once rather than image by image
+        self.raw_scale = 255
+        self.mean = np.asarray(data_mean, dtype=np.float32).reshape(-1, 1, 1)
 
     def encode_batch(self, image_batch):
         '''
@@ -43,16 +65,53 @@ class VGG_Encoder():
         '''
         # gets the dimensions of this batch
         batch_size, height, width, channels = image_batch.shape
-        # specify the dimension to our network.
         # channels has been moved to the first dimension as per caffe's requirements for networks
-        self.net.blobs['data'].reshape(batch_size, channels, height, width)
+        data = self.backend.input_buffer((batch_size, channels, height, width))
         
-        # load the batch into the network
-        for i in range(batch_size):
-            self.net.blobs['data'].data[i, ...] = self.transformer.preprocess('data', image_batch[i])
-            
-        # feed the data through the network
-        self.net.forward()
-        # the activation on the penultimate layer is our encoded features.
-        return self.net.blobs['fc7'].data
-        
\ No newline at end of file
+        # load the batch into the network, preprocessing straight into the input blob
+        self._preprocess(image_batch, data)
+        # the activation on the penultimate layer is our encoded features
+        return self.backend.forward(self.output_layer)
+
+    def preprocess(self, image_batch):
+        '''
+        Preprocesses ``image_batch`` (`size of batch`, height, width, channels) into a new array ready for
+        ``encode_preprocessed``. This does not touch the network, so can be done on another thread while the network
+        is busy.
+        '''
+        batch_size, height, width, channels = image_batch.shape
+        out = np.empty((batch_size, channels, height, width), dtype=np.float32)
+        return self._preprocess(image_batch, out)
+
+    def encode_preprocessed(self, data):
+        '''
+        Encodes a batch already preprocessed by ``preprocess``. Returns an array of shape (`size of batch`, 4096).
+        '''
+        return self.backend.forward(self.output_layer, data)
+
+    def fingerprint(self):
+        '''
+        Returns a hex string identifying the encodings this encoder gives - see embedding_cache.encoder_fingerprint
+        '''
+        return vgg_fingerprint(self.data_mean, self.model_path, self.weights_path, self.output_layer,
+                               self.backend_name)
+
+    def _preprocess(self, image_batch, out):
+        '''
+        Preprocesses the (`size of batch`, height, width, channels) RGB ``image_batch`` into ``out``, a float32 array
+        of shape (`size of batch`, channels, height, width) in BGR.
+        '''
+        # channel swap and transpose are views, so the scale reads the batch once and writes ``out`` once
+        bgr_chw = image_batch[..., ::-1].transpose(0, 3, 1, 2)
+        np.multiply(bgr_chw, self.raw_scale, out=out, dtype=np.float32)
+        out -= self.mean
+        return out
+
+def vgg_fingerprint(data_mean, model_path=MODEL_PATH, weights_path=WEIGHTS_PATH, output_layer='fc7',
+                    backend='caffe'):
+    '''
+    Returns the fingerprint of the VGG_Encoder with these arguments, without loading the network. Backends give
+    slightly different encodings, so encodings are cached by backend too.
+    '''
+    return encoder_fingerprint(model_path, weights_path, data_mean, output_layer,
+                               extra=PREPROCESS_VERSION + backend)